@@ -12,6 +12,13 @@ import serial
 import time
 import serial.tools.list_ports as lsports
 import struct
+import json
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+from multiprocessing import TimeoutError
+
+from waitFcts import Deadline
 
 from PyQt5.QtCore import QObject, pyqtSignal
 
@@ -26,9 +33,19 @@ class Arduino(QObject):
     syncFinished = pyqtSignal()
     #Color mode in R-B acquisition
     rbColorModes = ['Red and Blue', 'Red only', 'Blue only']
+    rbModeChars = ['G', 'R', 'B'] #Char of each color mode for the driver
+
+    #Binary framed protocol (see the sketches) : STX, LEN, CMD, PAYLOAD, CHECKSUM
+    STX = 0x02
+    binarySpeed = 115200 #Baud rate negotiated for the binary protocol
+    maxListSize = 246 #Max nb of LEDs in the list of one configuration frame
 
-    def __init__(self, led,speed=9600, timeout=1, parent=None):
-        """ CLASS CONSTRUCTOR """
+    def __init__(self, led,speed=9600, timeout=1, parent=None, port=None):
+        """ CLASS CONSTRUCTOR
+        If port is given, only this port is tried (once), else all the ports
+        are scanned. With led=None, the driver found on the port is accepted
+        whatever its LED.
+        """
 
         QObject.__init__(self,parent)
 
@@ -39,12 +56,31 @@ class Arduino(QObject):
         self.connected = False
         self.ser = None
         self.port = None
+        self.lock = threading.RLock() #One exchange with the driver at a time (sync worker, GUI toggles)
+        self.registryOwned = False #Connection kept open by the CyclopsRegistry
+        self.binaryProtocol = False #True if the driver answered the binary protocol negotiation
+        self.lastConfig = None #Last configuration acknowledged by the driver (see synchronization)
+
+        if port is not None:
+            self._portConnection(port)
+        else:
+            attempt = 0
+            while (not self.connected) and attempt<20:
+                self._portScanning()
+                time.sleep(0.5)
+                attempt+=1
 
-        attempt = 0
-        while (not self.connected) and attempt<20:
-            self._portScanning()
-            time.sleep(0.5)
-            attempt+=1
+    def _portConnection(self, port):
+        """
+        Try to connect to the Teensy on a given port.
+        """
+        try:
+            self.ser = serial.Serial(port, self.speed, timeout=self.timeout)
+            self.port = port
+            self._ledHandshake()
+        except Exception as e:
+            print("Failed to connect on", port, e)
+            self.ser = None
 
     def _portScanning(self):
         """
@@ -78,13 +114,108 @@ class Arduino(QObject):
 
         self.sendChar('C') #Send C char for Connection.
         ledDriver = self.readData(1,printData=True,integers = True) #nlines,printData=False,array=True,integers=False,Floaters=False
+        if self.led is None and ledDriver[0] in (0, 1, 2): #Any LED driver accepted
+            self.led = ledDriver[0]
         if ledDriver[0] == self.led:
             self.connected = True
             print('Arduino connected')
+            self._protocolNegotiation()
         else:
             self.ser.close()
             self.ser=None
 
+    def _frame(self, cmd, payload=b''):
+        """
+        Build a binary frame : STX, LEN (CMD + PAYLOAD bytes), CMD, PAYLOAD,
+        CHECKSUM ((LEN + CMD + PAYLOAD bytes) modulo 256).
+        """
+        body = bytes([ord(cmd)])+bytes(payload)
+        return bytes([Arduino.STX, len(body)])+body+bytes([(len(body)+sum(body)) & 0xFF])
+
+    def _readFrame(self, timeout=None):
+        """
+        Read the next binary frame, the bytes before the STX are skipped.
+        Return (cmd, payload) or None if timed out or wrong checksum.
+        """
+        deadline = Deadline(self.timeout if timeout is None else timeout)
+        serialTimeout = self.ser.timeout
+        self.ser.timeout = deadline.remaining() #Each read is bounded by the frame timeout
+        try:
+            while True:
+                if deadline.expired():
+                    return None
+                if self.ser.read(1) == bytes([Arduino.STX]):
+                    break
+            length = self.ser.read(1)
+            if not length:
+                return None
+            body = self.ser.read(length[0]+1)
+        finally:
+            self.ser.timeout = serialTimeout
+        if len(body) != length[0]+1 or (length[0]+sum(body[:-1])) & 0xFF != body[-1]:
+            print('Wrong frame received from driver ', self.led)
+            return None
+        return (chr(body[0]), body[1:-1])
+
+    def _ackCheck(self, ack):
+        """
+        Return True if the frame is a positive ack from this driver.
+        """
+        return ack is not None and ack[0] == 'K' and len(ack[1]) == 3 and ack[1][0] == 0 and ack[1][1] == self.led
+
+    def _speedFrame(self, speed):
+        """
+        Ask the driver to switch its serial port to speed (bauds), the ack is
+        sent at the old speed. Return True if acknowledged.
+        """
+        self.ser.reset_input_buffer()
+        self.ser.write(self._frame('S', struct.pack('<I', speed)))
+        return self._ackCheck(self._readFrame(0.3))
+
+    def _protocolNegotiation(self):
+        """
+        Switch to the binary protocol at binarySpeed if the driver firmware
+        knows it. An old firmware doesn't answer : the ASCII protocol at the
+        default speed is kept.
+        """
+        self.binaryProtocol = False
+        try:
+            if self._speedFrame(Arduino.binarySpeed):
+                self.ser.baudrate = Arduino.binarySpeed
+                self.binaryProtocol = True
+                print('Driver ', self.led, ' : binary protocol at ', Arduino.binarySpeed, ' bauds')
+            else:
+                print('Driver ', self.led, ' : no binary protocol, ASCII protocol kept')
+        except Exception as e:
+            print('Driver ', self.led, ' : protocol negotiation error, ASCII protocol kept ', e)
+
+    def sendConfig(self, illumTime, ledSeq=None, colorMode=None, greenFrameInterval=None):
+        """
+        Send the whole configuration in one binary frame and wait for its ack :
+        illumination time, and LED list (rgbMode) or color mode and green frame
+        interval (rbMode). Without ledSeq and colorMode, only the illumination
+        time is changed.
+        Return True if the configuration was acknowledged.
+        """
+        msIllumTime = int(illumTime)
+        usIllumTime = int(round((illumTime-msIllumTime),3)*1000) #Round and convert to us then to INT
+        ledSeq = ledSeq or []
+        mode = 0
+        if ledSeq:
+            mode = ord('L')
+        elif colorMode is not None:
+            mode = ord(Arduino.rbModeChars[Arduino.rbColorModes.index(colorMode)])
+        payload = struct.pack('<HHBHB', msIllumTime, usIllumTime, mode, int(greenFrameInterval or 0), len(ledSeq))+bytes(ledSeq)
+        try:
+            self.ser.reset_input_buffer()
+            self.ser.write(self._frame('F', payload))
+        except serial.SerialException as e:
+            print(("Serial port error, driver disconnected : ",e))
+            self.connected = False #The registry will revalidate the port
+            return False
+        ack = self._readFrame()
+        return self._ackCheck(ack) and ack[1][2] == (len(ledSeq) if ledSeq else ack[1][2])
+
     def __repr__(self):
         """
         How the object is representing itself when printed/called
@@ -123,6 +254,9 @@ class Arduino(QObject):
 #            Immediate response: %s
 #            """
 #            %(char,send))
+        except serial.SerialException as e:
+            print(("Serial port error, driver disconnected : ",e))
+            self.connected = False #The registry will revalidate the port
         except Exception as e:
             print(("Some error occurred, here is the exception: ",e))
 
@@ -289,7 +423,8 @@ class Arduino(QObject):
     def resetFrameCounter(self):
         """
         Send Z char to tell reset the framecounter of the arduino to Zero.
-        Can be used to speedup the process between loop acquisition.
+        Can be used to speedup the process between loop acquisition (used by
+        synchronization when the configuration didn't change).
         """
         self.sendChar('Z')
 
@@ -298,6 +433,11 @@ class Arduino(QObject):
         Put the cyclops driver in one color mode with the right time of illum
         for the conceirned LED.
         """
+        with self.lock:
+            self._oneColor(color, illumTimeList)
+
+    def _oneColor(self, color, illumTimeList):
+        self.lastConfig = None #LED mode changed outside of the synchronization
         sync = False
         failCount = 0
         while(not sync and failCount > 10):
@@ -320,7 +460,9 @@ class Arduino(QObject):
         Disconnect the current trigger mode of the LED driver,
         it will no more turn his LED on
         """
-        self.sendChar('N')
+        with self.lock:
+            self.lastConfig = None #LED mode changed outside of the synchronization
+            self.sendChar('N')
 
     def readData(self,nlines,printData=False,array=True,integers=False,Floaters=False):
 
@@ -395,26 +537,81 @@ class Arduino(QObject):
             print("Nothing to return since array = False")
 
 
-    def synchronization(self, illumTime, rgbLedRatio=None, greenFrameInterval=None, colorMode=None):
-        """
-        Function in charge of the
-        """
+    def synchronization(self, illumTime, rgbLedRatio=None, greenFrameInterval=None, colorMode=None, deadline=None):
+        """
+        Function in charge of the configuration of the driver for a sequence
+        acquisition : send the illumination time then the LED mode.
+        Each step is tried again until acknowledged or until the deadline
+        (waitFcts.Deadline) expires.
+        The last acknowledged configuration is cached : if it didn't change,
+        only the frame counter is reset ('Z'), if only the illumination time
+        changed, only this one is sent.
+        Return True if all the settings were acknowledged by the driver.
+        """
+        if deadline is None:
+            deadline = Deadline()
+        #A worker of a previous synchronization may still talk to the driver
+        remaining = deadline.remaining()
+        if not self.lock.acquire(timeout=-1 if remaining is None else remaining):
+            print(('Driver num ',self.led,' busy, synchronization not started'))
+            return False
+        try:
+            return self._synchronization(illumTime, rgbLedRatio, greenFrameInterval, colorMode, deadline)
+        finally:
+            self.lock.release()
+
+    def _synchronization(self, illumTime, rgbLedRatio, greenFrameInterval, colorMode, deadline):
         self.syncStarted.emit()
-        if self.isConnected():
+        sync = False
+        ledSeq = None
+        if rgbLedRatio:
+            ledSeq = [0]*rgbLedRatio[0]+[1]*rgbLedRatio[1]+[2]*rgbLedRatio[2]
+        if not (greenFrameInterval and colorMode):
+            colorMode = None
+        config = (illumTime[self.led], tuple(ledSeq or ()), colorMode, greenFrameInterval if colorMode else None)
+        if self.isConnected() and config == self.lastConfig:
+            #Same configuration as the last one acknowledged : only reset the frame counter
+            print(('Driver num ',self.led,' configuration unchanged'))
+            self.resetFrameCounter()
+            sync = self.isConnected()
+        elif self.isConnected() and self.lastConfig is not None and config[1:] == self.lastConfig[1:]:
+            #Same LED mode : only the illumination time is sent, then the frame counter is reset
+            print(('Driver num ',self.led,' illumination time changed'))
+            while(not sync and not deadline.expired() and self.isConnected()):
+                if self.binaryProtocol:
+                    sync = self.sendConfig(illumTime[self.led])
+                else:
+                    sync = self.sendIllumTime(illumTime[self.led])
+                print('sync value of attempt to set illumtime  : ', sync)
+            if sync:
+                self.resetFrameCounter()
+                sync = self.isConnected()
+        elif self.isConnected() and self.binaryProtocol and len(ledSeq or []) <= Arduino.maxListSize:
+            print(('Driver num ',self.led,' is connected (binary protocol)'))
+            #Whole configuration in one frame, one ack
+            while(not sync and not deadline.expired() and self.isConnected()):
+                sync = self.sendConfig(illumTime[self.led], ledSeq, colorMode, greenFrameInterval)
+                print('sync value of attempt to send the configuration : ', sync)
+        elif self.isConnected():
             print(('Driver num ',self.led,' is connected'))
             sync = False
-            while(not sync):
+            while(not sync and not deadline.expired() and self.isConnected()):
                 sync = self.sendIllumTime(illumTime[self.led])
                 print('sync value of attempt to set illumtime  : ', sync)
-            if rgbLedRatio: #if rgbLedRatio is not None, this statement will be executed
+            if sync and rgbLedRatio: #if rgbLedRatio is not None, this statement will be executed
                 sync = False
-                while(not sync):
+                while(not sync and not deadline.expired() and self.isConnected()):
                     sync = self.rgbModeSettings(rgbLedRatio)
                     print('sync value of attempt to set rgbmode : ', sync)
-            elif greenFrameInterval and colorMode:
-                self.rbModeSettings(greenFrameInterval,colorMode)#TO DO : add the checking of color mode here
-            self.closeConn()
+            elif sync and colorMode:
+                sync = self.rbModeSettings(greenFrameInterval,colorMode)#TO DO : add the checking of color mode here
+        #Configuration cached only while the connection stays open
+        self.lastConfig = config if sync else None
+        if self.isConnected():
+            if not self.registryOwned: #The registry keeps its connections open
+                self.closeConn()
         self.syncFinished.emit()
+        return sync
 
     def isConnected(self):
         """
@@ -425,40 +622,191 @@ class Arduino(QObject):
     def closeConn(self):
         """
         CLOSE THE USB CONNECTION
+        The driver is set back to the default speed for the next connection.
         """
+        with self.lock:
+            self._closeConn()
 
+    def _closeConn(self):
+        if self.binaryProtocol and self.ser.baudrate != self.speed:
+            try:
+                self._speedFrame(self.speed)
+            except Exception as e:
+                print('Driver ', self.led, ' speed not restored : ', e)
+            self.binaryProtocol = False
         self.ser.close()
         self.connected = False
+        self.lastConfig = None
         print(("Arduino connection to "+str(self.port)+" closed!"))
 
 
+class CyclopsRegistry(object):
+    """
+    Long-lived connections to the Cyclops LED drivers.
+    Each Teensy is opened once and kept open for the whole session, so the
+    LED toggles and the syncs don't scan the ports and handshake each time.
+    The LED of each driver is cached on disk by USB serial number : at the
+    next session, the port of a LED is found without opening the other ports.
+    A driver is reopened (and its port revalidated) only after an error.
+    """
+
+    defaultCachePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cyclopsPorts.json')
+
+    def __init__(self, cachePath=None, scanAttempts=3):
+        self.cachePath = cachePath or CyclopsRegistry.defaultCachePath
+        self.scanAttempts = scanAttempts
+        self.drivers = {} #led : Arduino
+        self.cache = {} #USB serial number : led
+        self._lock = threading.Lock()
+        try:
+            with open(self.cachePath) as cacheFile:
+                self.cache = json.load(cacheFile)
+        except (IOError, ValueError):
+            print('No Cyclops port cache')
+
+    def _saveCache(self):
+        try:
+            with open(self.cachePath, 'w') as cacheFile:
+                json.dump(self.cache, cacheFile, indent=4)
+        except IOError as e:
+            print('Cyclops port cache not saved : ', e)
+
+    def _teensyPorts(self):
+        """
+        Return the list of (port, USB serial number) of the Teensy boards.
+        """
+        return [(port.device, port.serial_number or port.device)
+                for port in lsports.comports() if 'Teensy' in port.description]
+
+    def _register(self, driver, serialNumber):
+        driver.registryOwned = True
+        self.drivers[driver.led] = driver
+        if self.cache.get(serialNumber) != driver.led:
+            self.cache[serialNumber] = driver.led
+            self._saveCache()
+
+    def _scan(self, ports):
+        """
+        Open the Teensy ports not owned by the registry and register each
+        driver found.
+        """
+        ownedPorts = [driver.port for driver in self.drivers.values() if driver.isConnected()]
+        for (port, serialNumber) in ports:
+            if port in ownedPorts:
+                continue
+            driver = Arduino(None, port=port)
+            if driver.isConnected():
+                self._register(driver, serialNumber)
+
+    def driver(self, led):
+        """
+        Return the open Arduino driving a LED (0 : red, 1 : green, 2 : blue),
+        None if it can't be found.
+        """
+        with self._lock:
+            driver = self.drivers.get(led)
+            if driver is not None and driver.isConnected():
+                return driver
+            self.invalidate(led)
+            ports = self._teensyPorts()
+            #Port of the cached serial number first
+            for (port, serialNumber) in ports:
+                if self.cache.get(serialNumber) == led:
+                    driver = Arduino(led, port=port)
+                    if driver.isConnected():
+                        self._register(driver, serialNumber)
+                        return driver
+            #Cache missing or wrong : scan the other Teensy ports
+            attempt = 0
+            while led not in self.drivers and attempt < self.scanAttempts:
+                if attempt:
+                    time.sleep(0.5)
+                    ports = self._teensyPorts()
+                self._scan(ports)
+                attempt += 1
+            driver = self.drivers.get(led)
+            if driver is None:
+                print('Cyclops driver ', led, ' not found')
+            return driver
+
+    def invalidate(self, led):
+        """
+        Close the connection to a driver, it will be reopened at the next call
+        of driver().
+        """
+        driver = self.drivers.pop(led, None)
+        if driver is not None and driver.ser is not None:
+            try:
+                driver.closeConn()
+            except Exception as e:
+                print('Cyclops driver ', led, ' close error : ', e)
+
+    def closeAll(self):
+        """
+        Close all the connections (end of the session).
+        """
+        with self._lock:
+            for led in list(self.drivers.keys()):
+                self.invalidate(led)
+
+registry = None
+registryLock = threading.Lock() #The first calls can come from several sync workers at once
+
+def cyclopsRegistry():
+    """
+    Return the CyclopsRegistry of the session, created at the first call.
+    """
+    global registry
+    with registryLock:
+        if registry is None:
+            registry = CyclopsRegistry()
+    return registry
+
+
 ### Arduino-related function
 
 
-def synchronization(illumTime, rgbLedRatio=None, greenFrameInterval=None, colorMode=None):
+def _driverSynchronization(driverNb, illumTime, rgbLedRatio, greenFrameInterval, colorMode, deadline):
+    """
+    Worker of the synchronization : configure one LED driver.
+    Return the ack of the driver, None if it is not connected.
+    """
+    driver = cyclopsRegistry().driver(driverNb)
+    if driver is None:
+        print(('Driver num ',driverNb,' is NOT connected'))
+        return None
+    return driver.synchronization(illumTime, rgbLedRatio, greenFrameInterval, colorMode, deadline)
+
+def synchronization(illumTime, rgbLedRatio=None, greenFrameInterval=None, colorMode=None, timeout=10.):
     """
     Initialize and send the information to each LED driver.
+    The drivers are configured in parallel (one worker thread per driver)
+    within one overall timeout (s).
+    Return a dictionary {driver nb : ack}, ack is True if the settings were
+    acknowledged, False if not (or timed out) and None if not connected.
     """
     print('Synchronization fct from Teensy called')
     ledDriverNb=[0,1,2] #[Red, Green, Blue]
+    deadline = Deadline(timeout)
+    cyclopsRegistry() #Created here, before the workers look their driver up
+    pool = ThreadPool(processes=len(ledDriverNb))
+    results = {}
     for driverNb in ledDriverNb:
-        driver = Arduino(driverNb)
-        if driver.isConnected():
-            print(('Driver num ',driverNb,' is connected'))
-            sync = False
-            while(not sync):
-                sync = driver.sendIllumTime(illumTime[driverNb])
-                print('sync value of attempt to set illumtime  : ', sync)
-            if rgbLedRatio: #if rgbLedRatio is not None, this statement will be executed
-                sync = False
-                while(not sync):
-                    sync = driver.rgbModeSettings(rgbLedRatio)
-                    print('sync value of attempt to set rgbmode : ', sync)
-            elif greenFrameInterval and colorMode:
-                driver.rbModeSettings(greenFrameInterval,colorMode)#TO DO : add the checking of color mode here
-            driver.closeConn()
-        else:
-            print(('Driver num ',driverNb,' is NOT connected'))
+        results[driverNb] = pool.apply_async(_driverSynchronization,
+                                             (driverNb, illumTime, rgbLedRatio, greenFrameInterval, colorMode, deadline))
+    pool.close() #No join : a worker still talking to its driver after the deadline ends by itself, holding the driver lock
+    acks = {}
+    for driverNb in ledDriverNb:
+        try:
+            acks[driverNb] = results[driverNb].get(deadline.remaining())
+        except TimeoutError:
+            print(('Driver num ',driverNb,' synchronization timed out'))
+            acks[driverNb] = False
+        except Exception as e:
+            print(('Driver num ',driverNb,' synchronization error : ',e))
+            acks[driverNb] = False
+    print('Synchronization acks : ', acks)
+    return acks
 
 
 
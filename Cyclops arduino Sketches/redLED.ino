@@ -15,6 +15,11 @@ int listSize =0;
 
 int greenFrameInterval;
 
+//Binary framed protocol : STX, LEN, CMD, PAYLOAD (LEN-1 bytes), CHECKSUM
+//LEN counts CMD and PAYLOAD bytes, CHECKSUM = (LEN + CMD + PAYLOAD bytes) modulo 256
+const byte STX = 0x02;
+byte frameBuffer[257];
+
 //RB mode : acquisition always begin with a red LED ON
 bool red=true;
 bool blue=false;
@@ -90,9 +95,13 @@ void loop()
           //Connect the trigger event function to "lightless" function
           cyclops0.set_trigger(triggerEventRising, RISING);
       }
+      else if(incomingByte == STX){
+        //Binary frame (baud negotiation or whole configuration)
+        readFrame();
+      }
       else if(incomingByte == 'Z'){
         //Reset the frame counter to prepare next acquisition (with same parameters)
-        frameCounter=0;
+        frameCounter=0; red = true; blue = false;
       }
 
       /// Acquisition mode information section ///
@@ -143,6 +152,89 @@ void loop()
     }
 }
 
+void sendAck(byte status)
+{
+  //Ack frame : status (0 OK, 1 wrong checksum, 2 wrong frame), LED driver, size of the LED list
+  byte ack[3] = {status, (byte)ledDriver, (byte)listSize};
+  byte checksum = 4 + 'K';
+  Serial.write(STX);
+  Serial.write((byte)4);
+  Serial.write('K');
+  for(int i = 0; i < 3; ++i){
+    Serial.write(ack[i]);
+    checksum += ack[i];
+  }
+  Serial.write(checksum);
+  Serial.flush();
+}
+
+void readFrame()
+{
+  byte len;
+  if(Serial.readBytes((char*)&len, 1) != 1 || len == 0){
+    return;
+  }
+  if(Serial.readBytes((char*)frameBuffer, len+1) != (size_t)(len+1)){
+    sendAck(2);
+    return;
+  }
+  byte checksum = len;
+  for(int i = 0; i < len; ++i){
+    checksum += frameBuffer[i];
+  }
+  if(checksum != frameBuffer[len]){
+    sendAck(1);
+    return;
+  }
+  byte cmd = frameBuffer[0];
+  byte *payload = frameBuffer+1;
+
+  // if it's an S, it sets the baud rate (uint32), ack sent at the old baud rate
+  if(cmd == 'S' && len == 5){
+    unsigned long baud = payload[0] | (payload[1]<<8) | ((unsigned long)payload[2]<<16) | ((unsigned long)payload[3]<<24);
+    sendAck(0);
+    Serial.begin(baud); //No effect on the Teensy USB serial (always at full USB speed)
+    Serial.setTimeout(100);
+  }
+  // if it's an F, it sets the whole configuration : ms (uint16), us (uint16),
+  // mode ('L', 'G', 'R', 'B' or 0 to keep the mode), greenFrameInterval (uint16),
+  // list size (uint8) and LED list (uint8 each)
+  else if(cmd == 'F' && len >= 9 && len == 9+payload[7]){
+    byte mode = payload[4];
+    if((mode == 'L' && payload[7] == 0) || (mode != 'L' && mode != 0 && (payload[5] | (payload[6]<<8)) == 0)){
+      sendAck(2); //Modulo by zero in the trigger functions
+      return;
+    }
+    msIllumTime = payload[0] | (payload[1]<<8);
+    usIllumTime = payload[2] | (payload[3]<<8);
+    if(mode != 0){
+      frameCounter=0; red = true; blue = false; //Reset default parameters
+      greenFrameInterval = payload[5] | (payload[6]<<8);
+      if(mode == 'L'){
+        ledList.clear();
+        listSize = payload[7];
+        for(int i = 0; i < listSize; ++i){
+          ledList.push_back(payload[8+i]);
+        }
+        cyclops0.set_trigger( rgbModeFct, RISING); // cyclops trigger on rising edges
+      }
+      else if(mode == 'G'){
+        cyclops0.set_trigger( rbModeFct, RISING); // cyclops trigger on rising edges
+      }
+      else if(mode == 'R'){
+        cyclops0.set_trigger( redModeFct, RISING); // cyclops trigger on rising edges
+      }
+      else if(mode == 'B'){
+        cyclops0.set_trigger( blueModeFct, RISING); // cyclops trigger on rising edges
+      }
+    }
+    sendAck(0);
+  }
+  else{
+    sendAck(2);
+  }
+}
+
 void triggerEventRising()
 {
   
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 25 10:41:18 2026
+
+@author: Johnstonlab
+
+Emulator of the Cyclops LED drivers firmware (Cyclops arduino Sketches) served
+on Linux pseudo-terminals, to test and benchmark the ArduinoTeensy
+communication without the Teensy boards.
+Run this file to benchmark the synchronization of the three drivers.
+"""
+#Packages import
+import os
+import tty
+import select
+import struct
+import threading
+import time
+import tempfile
+import contextlib
+
+#Class import
+import ArduinoTeensy
+from ArduinoTeensy import CyclopsRegistry, synchronization
+
+
+class CyclopsEmulator(object):
+    """
+    One Cyclops LED driver (ledDriver 0 : red, 1 : green, 2 : blue) answering
+    the protocol of the sketches on a pseudo-terminal : the port attribute is
+    the device to open with serial.Serial (or Arduino(led, port=port)).
+    --> Timings of the firmware :
+        - Serial.parseInt() ends on the first non-digit char or after the
+          Serial.setTimeout (parseIntTimeout, 100 ms), the ASCII commands
+          always end on the timeout since Python waits for the answer.
+        - 'M' waits 100 ms (delay(100)) before reading the mode char.
+        - latency (s) is added to each transfer in both directions (USB frame
+          and host scheduling).
+        - Bytes are not rate limited (Teensy USB serial), unless uart is True :
+          each byte then takes 10 bits at the current baud rate.
+    binaryFirmware=False emulates the firmware before the binary framed
+    protocol : the frames are ignored.
+    trigger() emulates a rising edge of the camera FIRE signal.
+    """
+
+    STX = 0x02
+
+    def __init__(self, ledDriver, latency=0.001, parseIntTimeout=0.1, binaryFirmware=True, uart=False):
+        self.ledDriver = ledDriver
+        self.latency = latency
+        self.parseIntTimeout = parseIntTimeout
+        self.binaryFirmware = binaryFirmware
+        self.uart = uart
+        self.baud = 9600
+
+        #Firmware state (same names as the sketches)
+        self.msIllumTime = 5
+        self.usIllumTime = 0
+        self.ledList = []
+        self.greenFrameInterval = 0
+        self.frameCounter = 0
+        self.mode = None #Trigger function : None (triggerEventRising), 'L' (rgbModeFct), 'G' (rbModeFct), 'R' (redModeFct), 'B' (blueModeFct)
+        self._resetAlternation()
+
+        self.nbBytesReceived = 0
+        self.nbBytesSent = 0
+        self._rx = [] #[ready time, byte] received from the host
+        (self.masterFd, self.slaveFd) = os.openpty()
+        tty.setraw(self.slaveFd)
+        self.port = os.ttyname(self.slaveFd)
+        self._stopEvent = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name='Cyclops emulator %d' % ledDriver)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopEvent.set()
+        self._thread.join()
+        os.close(self.masterFd)
+        os.close(self.slaveFd)
+
+    def _resetAlternation(self):
+        """
+        red = true; blue = false; of the sketches (one flag per driver).
+        """
+        self.alternation = (self.ledDriver == 0)
+
+    ### Serial port of the firmware ###
+    def _byteTime(self):
+        return 10./self.baud if self.uart else 0.
+
+    def _receive(self, timeout):
+        """
+        Wait up to timeout (s) for bytes from the host.
+        """
+        (readable, _, _) = select.select([self.masterFd], [], [], max(0., timeout))
+        if readable:
+            data = os.read(self.masterFd, 4096)
+            readyTime = time.perf_counter()+self.latency
+            for byte in data:
+                readyTime += self._byteTime()
+                self._rx.append([readyTime, byte])
+            self.nbBytesReceived += len(data)
+
+    def _peek(self, timeout):
+        """
+        Return the next byte without reading it, None if timed out.
+        """
+        deadline = time.perf_counter()+timeout
+        while True:
+            now = time.perf_counter()
+            if self._rx and self._rx[0][0] <= now:
+                return self._rx[0][1]
+            if now >= deadline or self._stopEvent.is_set():
+                return None
+            waitTime = deadline-now
+            if self._rx:
+                waitTime = min(waitTime, self._rx[0][0]-now)
+            self._receive(min(waitTime, 0.05))
+
+    def _read(self, timeout=0.):
+        """
+        Serial.read() (timeout=0, -1 > None) or timedRead().
+        """
+        byte = self._peek(timeout)
+        if byte is not None:
+            self._rx.pop(0)
+        return byte
+
+    def _parseInt(self):
+        """
+        Serial.parseInt() : skip the chars before the first digit, then read
+        the digits until a non-digit char or the timeout.
+        """
+        byte = self._peek(self.parseIntTimeout)
+        while byte is not None and not (byte == ord('-') or ord('0') <= byte <= ord('9')):
+            self._read()
+            byte = self._peek(self.parseIntTimeout)
+        if byte is None:
+            return 0
+        value = 0
+        negative = False
+        while byte is not None and (byte == ord('-') or ord('0') <= byte <= ord('9')):
+            if byte == ord('-'):
+                negative = True
+            else:
+                value = value*10+byte-ord('0')
+            self._read()
+            byte = self._peek(self.parseIntTimeout)
+        return -value if negative else value
+
+    def _readBytes(self, nb):
+        """
+        Serial.readBytes() : stop at the first timed out byte.
+        """
+        data = bytearray()
+        while len(data) < nb:
+            byte = self._read(self.parseIntTimeout)
+            if byte is None:
+                break
+            data.append(byte)
+        return bytes(data)
+
+    def _write(self, data):
+        time.sleep(self.latency+len(data)*self._byteTime())
+        os.write(self.masterFd, data)
+        self.nbBytesSent += len(data)
+
+    def _println(self, value):
+        self._write((str(value)+'\r\n').encode())
+
+    ### Firmware ###
+    def _loop(self):
+        while not self._stopEvent.is_set():
+            incomingByte = self._read(0.05)
+            if incomingByte is None:
+                continue
+            incomingByte = chr(incomingByte)
+            if incomingByte == 'C':
+                self._println(self.ledDriver)
+            elif incomingByte == 'E':
+                self.msIllumTime = self._parseInt()
+                self._println(self.msIllumTime)
+                self.usIllumTime = self._parseInt()
+                self._println(self.usIllumTime)
+            elif incomingByte in ('R', 'G', 'B'):
+                self.ledList = [['R', 'G', 'B'].index(incomingByte)]
+                self.mode = 'L'
+            elif incomingByte == 'N':
+                self.mode = None
+            elif incomingByte == chr(CyclopsEmulator.STX) and self.binaryFirmware:
+                self._readFrame()
+            elif incomingByte == 'Z':
+                self.frameCounter = 0
+                self._resetAlternation()
+            elif incomingByte == 'M':
+                self.frameCounter = 0
+                self._resetAlternation()
+                time.sleep(0.1)
+                incomingByte = self._read()
+                if incomingByte == ord('L'):
+                    listSize = self._parseInt()
+                    self._println(listSize)
+                    self.ledList = []
+                    for i in range(listSize):
+                        self.ledList.append(self._parseInt())
+                        self._println(self.ledList[-1])
+                    self.mode = 'L'
+                elif incomingByte in (ord('G'), ord('R'), ord('B')):
+                    self.greenFrameInterval = self._parseInt()
+                    self.mode = chr(incomingByte)
+                    self._println(self.greenFrameInterval)
+
+    def _sendAck(self, status):
+        ack = bytes([status, self.ledDriver, len(self.ledList) & 0xFF])
+        self._write(bytes([CyclopsEmulator.STX, 4, ord('K')])+ack+bytes([(4+ord('K')+sum(ack)) & 0xFF]))
+
+    def _readFrame(self):
+        length = self._readBytes(1)
+        if not length or length[0] == 0:
+            return
+        body = self._readBytes(length[0]+1)
+        if len(body) != length[0]+1:
+            self._sendAck(2)
+            return
+        if (length[0]+sum(body[:-1])) & 0xFF != body[-1]:
+            self._sendAck(1)
+            return
+        (cmd, payload) = (chr(body[0]), body[1:-1])
+        if cmd == 'S' and len(payload) == 4:
+            self._sendAck(0) #At the old baud rate
+            self.baud = struct.unpack('<I', payload)[0]
+        elif cmd == 'F' and len(payload) >= 8 and len(payload) == 8+payload[7]:
+            (msIllumTime, usIllumTime, mode, greenFrameInterval, listSize) = struct.unpack('<HHBHB', payload[:8])
+            if (mode == ord('L') and listSize == 0) or (mode not in (0, ord('L')) and greenFrameInterval == 0):
+                self._sendAck(2)
+                return
+            self.msIllumTime = msIllumTime
+            self.usIllumTime = usIllumTime
+            if mode != 0:
+                self.frameCounter = 0
+                self._resetAlternation()
+                self.greenFrameInterval = greenFrameInterval
+                if mode == ord('L'):
+                    self.ledList = list(payload[8:])
+                self.mode = chr(mode)
+            self._sendAck(0)
+        else:
+            self._sendAck(2)
+
+    def trigger(self):
+        """
+        Rising edge of the FIRE signal : return True if the LED of this driver
+        is turned on for this frame.
+        """
+        ledOn = False
+        greenFrame = self.greenFrameInterval and self.frameCounter % self.greenFrameInterval == 0
+        if self.mode is None:
+            self._println("Rising edge detected")
+        elif self.mode == 'L':
+            ledOn = bool(self.ledList) and self.ledList[self.frameCounter % len(self.ledList)] == self.ledDriver
+        elif self.ledDriver == 1:
+            ledOn = bool(greenFrame)
+        elif greenFrame:
+            pass #Green LED only
+        elif self.mode == 'G':
+            ledOn = self.alternation
+            self.alternation = not self.alternation
+        else:
+            ledOn = (self.mode == ['R', 'G', 'B'][self.ledDriver])
+        self.frameCounter += 1
+        return ledOn
+
+    def illumTime(self):
+        """
+        Illumination time (ms) set in the firmware.
+        """
+        return self.msIllumTime+self.usIllumTime/1000.
+
+
+class EmulatorRegistry(CyclopsRegistry):
+    """
+    CyclopsRegistry finding the drivers on the emulators ports instead of the
+    Teensy USB ports.
+    """
+
+    def __init__(self, emulators, cachePath=None, scanAttempts=1):
+        self.emulators = emulators
+        CyclopsRegistry.__init__(self, cachePath, scanAttempts)
+
+    def _teensyPorts(self):
+        return [(emulator.port, 'EMU%d' % emulator.ledDriver) for emulator in self.emulators]
+
+
+def _timed(function, *args, **kwargs):
+    """
+    Return (time (s), result) of a call, its prints are hidden.
+    """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        return (time.perf_counter()-start, result)
+
+
+def benchmark(latency=0.001, binaryFirmware=True, uart=False, nbLoops=5):
+    """
+    Time the connection, the synchronization(), the ledToggle of OMMI and
+    the loop mode resync (unchanged and changed illumination time) with three
+    emulated drivers.
+    Return a dictionary {step : time (s)}.
+    """
+    emulators = [CyclopsEmulator(led, latency, binaryFirmware=binaryFirmware, uart=uart).start()
+                 for led in (0, 1, 2)]
+    cacheDir = tempfile.mkdtemp()
+    ArduinoTeensy.registry = EmulatorRegistry(emulators, os.path.join(cacheDir, 'cyclopsPorts.json'))
+    illumTime = [10.07, 10.07, 5.]
+    timings = {}
+    try:
+        def connection():
+            return [ArduinoTeensy.cyclopsRegistry().driver(led) for led in (0, 1, 2)]
+        def ledToggle(color):
+            #OMMI.ledToggle with the registry
+            for driverNb in (0, 1, 2):
+                driver = ArduinoTeensy.cyclopsRegistry().driver(driverNb)
+                if driver is not None:
+                    if color is None:
+                        driver.ledOff()
+                    else:
+                        driver.oneColor(color, illumTime)
+        (timings['Connection'], drivers) = _timed(connection)
+        (timings['rgbMode sync'], acks) = _timed(synchronization, illumTime, rgbLedRatio=[2, 1, 1])
+        (timings['rbMode sync'], acks) = _timed(synchronization, illumTime, greenFrameInterval=5, colorMode='Red and Blue')
+        loopTimes = [_timed(synchronization, illumTime, greenFrameInterval=5, colorMode='Red and Blue')[0]
+                     for i in range(nbLoops)]
+        timings['Loop resync (unchanged)'] = sum(loopTimes)/nbLoops
+        loopTimes = []
+        for i in range(nbLoops):
+            illumTime = [value+0.5 for value in illumTime]
+            loopTimes.append(_timed(synchronization, illumTime, greenFrameInterval=5, colorMode='Red and Blue')[0])
+        timings['Loop resync (illum time changed)'] = sum(loopTimes)/nbLoops
+        (timings['ledToggle green'], result) = _timed(ledToggle, 1)
+        (timings['ledToggle off'], result) = _timed(ledToggle, None)
+        timings['Bytes to the drivers'] = sum(emulator.nbBytesReceived for emulator in emulators)
+        #Check that the emulated firmwares got the last configuration
+        for emulator in emulators:
+            if abs(emulator.illumTime()-illumTime[emulator.ledDriver]) > 0.001:
+                print('WARNING : driver ', emulator.ledDriver, ' illumination time ', emulator.illumTime())
+    finally:
+        _timed(ArduinoTeensy.cyclopsRegistry().closeAll)
+        ArduinoTeensy.registry = None
+        for emulator in emulators:
+            emulator.stop()
+    return timings
+
+
+if __name__ == '__main__':
+    for (firmware, binaryFirmware) in (('ASCII', False), ('binary', True)):
+        for latency in (0.001, 0.005):
+            print('--- ', firmware, ' firmware, latency ', latency*1000, ' ms ---')
+            for (step, value) in benchmark(latency, binaryFirmware).items():
+                if step.startswith('Bytes'):
+                    print(step, ' : ', value)
+                else:
+                    print(step, ' : ', round(value*1000, 1), ' ms')
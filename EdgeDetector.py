@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 11:48:05 2026
+
+@author: Johnstonlab
+
+Class of the vectorized edge detector used on the LabJack stream blocks.
+"""
+#Packages import
+import numpy as np
+
+
+class EdgeDetector(object):
+    """
+    Detect the rising edges of a TTL signal in consecutive blocks of samples.
+    Thresholds are applied with hysteresis : the signal is HIGH above
+    highLevel, LOW under lowLevel and keeps its previous state in between, so
+    the noise around a threshold does not give several edges.
+    Each edge is found to the sample and its time is interpolated where the
+    signal crosses highLevel.
+    The state and the last sample are kept between blocks, an edge
+    overlapping two blocks is detected once.
+    """
+
+    def __init__(self, sampleRate, highLevel=2.4, lowLevel=0.8):
+        self.sampleRate = float(sampleRate)
+        self.highLevel = highLevel
+        self.lowLevel = lowLevel
+        self.state = -1 #-1 unknown, 0 LOW, 1 HIGH
+        self.lastSample = np.nan
+
+    def reset(self):
+        """
+        Forget the state of the signal.
+        """
+        self.state = -1
+        self.lastSample = np.nan
+
+    def _states(self, samples):
+        """
+        Return the hysteresis state (-1, 0 or 1) of each sample, the state of
+        the previous block is used for the first samples.
+        """
+        codes = np.full(samples.shape[0]+1, -1, dtype=np.int8)
+        codes[0] = self.state
+        codes[1:][samples >= self.highLevel] = 1
+        codes[1:][samples <= self.lowLevel] = 0
+        #Forward fill of the samples in between the thresholds (and NaN)
+        defined = np.where(codes >= 0, np.arange(codes.shape[0]), 0)
+        np.maximum.accumulate(defined, out=defined)
+        return codes[defined]
+
+    def process(self, firstSample, samples):
+        """
+        Detect the rising edges of a block of samples, firstSample is the
+        index of the first sample of the block in the stream.
+        Return (edgeSamples, edgeTimes) : the index of the first HIGH sample
+        of each edge and the interpolated time (s) of the crossing.
+        """
+        samples = np.asarray(samples, dtype=np.float64)
+        if samples.shape[0] == 0:
+            return (np.empty(0, dtype=np.int64), np.empty(0))
+        states = self._states(samples)
+        edges = np.nonzero((states[:-1] == 0) & (states[1:] == 1))[0] #Index in the block
+
+        #Linear interpolation of the highLevel crossing between the previous sample and the edge sample
+        previous = np.concatenate(([self.lastSample], samples[:-1]))[edges]
+        current = samples[edges]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = (self.highLevel-previous)/(current-previous)
+        fraction = np.clip(np.nan_to_num(fraction, nan=1.), 0., 1.)
+        edgeSamples = firstSample+edges
+        edgeTimes = (edgeSamples-1+fraction)/self.sampleRate
+
+        self.state = states[-1]
+        self.lastSample = samples[-1]
+        return (edgeSamples, edgeTimes)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 10:12:37 2026
+
+@author: Johnstonlab
+
+Class of the frame clock based on a hardware counter of the LabJack.
+"""
+#Packages import
+import u3
+
+#Function import
+from Labjack import readSnapshot
+
+
+class FrameCounter(object):
+    """
+    Count the FIRE pulses of the camera with a hardware counter of the U3.
+    The counter counts every pulse, even the ones happening while the host is
+    stalled : the value read gives the exact nb of frames taken since start().
+    --> Wiring :
+        - Camera.FIRE > Labjack.EIO0 (Counter0 with pinOffset=8 and no timer,
+          FIO4-7 are used by the LEDs)
+    """
+
+    def __init__(self, device, pinOffset=8, counterNb=0):
+        self.device = device
+        self.pinOffset = pinOffset
+        self.counterNb = counterNb
+        self.count = 0 #Nb of FIRE pulses counted at the last read
+
+    def start(self):
+        """
+        Enable the counter on its pin and reset it.
+        """
+        if self.counterNb == 0:
+            self.device.configIO(TimerCounterPinOffset=self.pinOffset, EnableCounter0=True, NumberOfTimersEnabled=0)
+        else:
+            self.device.configIO(TimerCounterPinOffset=self.pinOffset, EnableCounter1=True, NumberOfTimersEnabled=0)
+        self.device.getFeedback(u3.Counter(self.counterNb, Reset=True))
+        self.count = 0
+        print('FIRE counter started on counter ', self.counterNb)
+
+    def read(self, ainChannels=()):
+        """
+        Read the counter and the AIN channels in one transaction.
+        Return the Snapshot, its count is the nb of FIRE pulses since start().
+        """
+        snapshot = readSnapshot(self.device, ainChannels, counterNb=self.counterNb)
+        self.count = snapshot.count
+        return snapshot
+
+    def crossCheck(self, dropDetector):
+        """
+        Compare the nb of FIRE pulses counted when called (after the camera
+        stopped) with the nb of frames numbered by the camera (see
+        FramePipeline.DropDetector).
+        Return the difference (pulses - camera frames), None if no frame.
+        """
+        if dropDetector is None or dropDetector.firstNumber is None:
+            return None
+        self.read() #Pulses counted until the end of the acquisition
+        nbCameraFrames = dropDetector.lastNumber-dropDetector.firstNumber+1
+        difference = self.count-nbCameraFrames
+        print('FIRE pulses counted : ', self.count, ' camera frames : ', nbCameraFrames,
+              ' dropped : ', dropDetector.droppedFrames)
+        if difference:
+            print('WARNING : ', difference, ' FIRE pulse(s) without camera frame number')
+        return difference
+
+    def stop(self):
+        """
+        Disable the counter.
+        """
+        try:
+            if self.counterNb == 0:
+                self.device.configIO(EnableCounter0=False)
+            else:
+                self.device.configIO(EnableCounter1=False)
+        except Exception as e:
+            print('FIRE counter stop error : ', e)
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:12:40 2026
+
+@author: Johnstonlab
+
+Class of the multi-stage frame saving pipeline.
+"""
+#Packages import
+import threading
+import queue
+
+
+class FramePipeline(object):
+    """
+    Multi-stage pipeline in charge of saving frames during an acquisition.
+    The capture stage (SequenceAcquisition._frameSaving) only drains the
+    circular buffer of the camera and put each frame in a bounded queue.
+    One or more writer workers take the frames out of the queue and save them
+    in the .tif files.
+    Frames are routed to the writers by .tif file index : a file is always
+    written by the same worker, in the order of acquisition
+    (see saveFcts.RollingTiffWriter).
+    A frame which can't be saved is skipped (tiffWriter.skip), the next ones
+    are still saved.
+    """
+
+    def __init__(self, tiffWriter, nbWriters=1, queueSize=64, progressCallback=None):
+        self.tiffWriter = tiffWriter
+        self.maxFrames = tiffWriter.maxFrames
+        self.nbWriters = max(1, int(nbWriters))
+        self.progressCallback = progressCallback #Called with the nb of frames saved
+
+        #One bounded queue per writer, the total size is shared between writers
+        writerQueueSize = max(1, int(queueSize/self.nbWriters))
+        self.queues = [queue.Queue(maxsize=writerQueueSize) for i in range(self.nbWriters)]
+        self.queueCapacity = writerQueueSize*self.nbWriters
+        self.workers = []
+
+        self.savedCount = 0
+        self.failedCount = 0 #Frames not saved (error of the writer)
+        self.peakFill = 0.
+        self._countLock = threading.Lock()
+
+    def start(self):
+        """
+        Start the writer workers.
+        """
+        for frameQueue in self.queues:
+            worker = threading.Thread(target=self._writerLoop, args=(frameQueue,))
+            worker.daemon = True #Never keep the program alive, stop() join them anyway
+            worker.start()
+            self.workers.append(worker)
+        print(self.nbWriters,' frame writer(s) started')
+
+    def put(self, img, imageCount):
+        """
+        Hand a frame to the writer in charge of its .tif file.
+        Block if this writer queue is full (back-pressure on the capture stage).
+        """
+        self._queueFrames(imageCount, [img])
+
+    def putBatch(self, block, firstImageCount):
+        """
+        Hand a (N, H, W) block of consecutive frames to the writers.
+        The block is only split where it overlaps two .tif files.
+        """
+        start = 0
+        nbImages = len(block)
+        while start < nbImages:
+            imageCount = firstImageCount+start
+            stop = min(nbImages, start+self.maxFrames-(imageCount % self.maxFrames)) #End of the current .tif file
+            self._queueFrames(imageCount, block[start:stop])
+            start = stop
+
+    def _queueFrames(self, imageCount, frames):
+        """
+        Put consecutive frames belonging to the same .tif file in the queue
+        of the writer in charge of this file.
+        """
+        frameQueue = self.queues[(imageCount//self.maxFrames) % self.nbWriters]
+        frameQueue.put((imageCount, frames))
+        fill = self.fillLevel()
+        if fill > self.peakFill:
+            self.peakFill = fill
+
+    def fillLevel(self):
+        """
+        Return how full the frame queues are (0. empty, 1. full).
+        """
+        return float(sum([frameQueue.qsize() for frameQueue in self.queues]))/self.queueCapacity
+
+    def _writerLoop(self, frameQueue):
+        """
+        Writer stage : save the frames of its queue until the stop flag (None)
+        is received.
+        """
+        while True:
+            item = frameQueue.get()
+            if item is None:
+                break
+            (firstImageCount, frames) = item
+            nbFailed = 0
+            for (frameNb, img) in enumerate(frames):
+                imageCount = firstImageCount+frameNb
+                try:
+                    self.tiffWriter.save(img, imageCount)
+                except Exception as e:
+                    #A writer must never die, the capture stage would block on its full queue
+                    print('Frame ', imageCount, ' not saved, error : ', e)
+                    nbFailed += 1
+                    try:
+                        self.tiffWriter.skip(imageCount) #File released, no record for this frame
+                    except Exception as e:
+                        print('Frame ', imageCount, ' not skipped, error : ', e)
+            with self._countLock:
+                self.savedCount += len(frames)-nbFailed
+                self.failedCount += nbFailed
+                savedCount = self.savedCount
+            if self.progressCallback is not None:
+                self.progressCallback(savedCount)
+
+    def stop(self):
+        """
+        Wait for the writers to save all the queued frames and stop them.
+        Return the nb of frames saved.
+        """
+        for frameQueue in self.queues:
+            frameQueue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        print('frame writers stopped, peak queue fill : ', round(self.peakFill*100), '%',
+              ' frames not saved : ', self.failedCount)
+        return self.savedCount
+
+
+class FrameRecordMerge(object):
+    """
+    Hand the record of each frame (RecordJoiner thread) to writeRecord in the
+    order of the frames, once the frame is written (writer thread) : a frame
+    not saved gets no record, whichever thread comes first.
+    The records and the frames must each come in the order of the frames.
+    """
+
+    def __init__(self, writeRecord):
+        self.writeRecord = writeRecord
+        self.records = {}   #imageCount : arguments of writeRecord
+        self.saved = {}     #imageCount : True if the frame was written, False if not
+        self.nextFrame = 0  #Next frame to hand
+        self._lock = threading.Lock()
+
+    def addRecord(self, imageCount, *record):
+        with self._lock:
+            if imageCount >= self.nextFrame: #Else its frame was not saved
+                self.records[imageCount] = record
+                self._flush()
+
+    def frameDone(self, imageCount, saved=True):
+        """
+        Flag the frame imageCount as written (or not), only the first call
+        of a frame counts.
+        """
+        with self._lock:
+            if imageCount >= self.nextFrame and imageCount not in self.saved:
+                self.saved[imageCount] = saved
+                self._flush()
+
+    def _flush(self):
+        while self.nextFrame in self.saved and (self.nextFrame in self.records or not self.saved[self.nextFrame]):
+            record = self.records.pop(self.nextFrame, None)
+            if self.saved.pop(self.nextFrame):
+                self.writeRecord(*record)
+            self.nextFrame += 1
+
+
+class DropDetector(object):
+    """
+    Follow the image numbers given by the camera to detect, in real time, the
+    frames dropped before reaching the circular buffer.
+    The camera frame index (number of the frame since the first one received)
+    is the index of the FIRE edge of this frame, i.e. of its LED and metadata.
+    """
+
+    #Metadata tags holding the camera own image number and timestamp, by priority
+    numberTags = ['FrameCounter', 'ImageNumber']
+    timeTags = ['TimeStampFromCamera', 'ElapsedTime-ms']
+
+    def __init__(self):
+        self.firstNumber = None
+        self.lastNumber = None
+        self.droppedFrames = 0 #Running count of dropped frames
+        self.gaps = [] #(camera frame index, nb of frames dropped before it)
+
+    def readMetadata(self, md):
+        """
+        Return the (image number, timestamp) of a pymmcore.Metadata object.
+        None for the missing tags.
+        """
+        imageNumber = None
+        timestamp = None
+        for tag in DropDetector.numberTags:
+            if md.HasTag(tag):
+                imageNumber = int(float(md.GetSingleTag(tag).GetValue()))
+                break
+        for tag in DropDetector.timeTags:
+            if md.HasTag(tag):
+                timestamp = float(md.GetSingleTag(tag).GetValue())
+                break
+        return (imageNumber, timestamp)
+
+    def check(self, imageNumber):
+        """
+        Check the image number of the next frame received.
+        Return (camera frame index, nb of frames dropped just before it).
+        """
+        if self.firstNumber is None:
+            self.firstNumber = imageNumber
+            self.lastNumber = imageNumber
+            return (0, 0)
+        dropped = max(0, imageNumber-self.lastNumber-1)
+        self.lastNumber = imageNumber
+        frameIndex = imageNumber-self.firstNumber
+        if dropped:
+            self.droppedFrames += dropped
+            self.gaps.append((frameIndex, dropped))
+            print(dropped,' frame(s) dropped before camera frame ', frameIndex, ' - total : ', self.droppedFrames)
+        return (frameIndex, dropped)
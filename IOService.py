@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 27 11:02:36 2026
+
+@author: Johnstonlab
+
+Class of the I/O service finishing the files written during the acquisitions.
+"""
+#Packages import
+import os
+import atexit
+import threading
+import queue
+from time import perf_counter
+from concurrent.futures import Future
+
+#IOService of the session (see ioService)
+service = None
+
+
+def fsyncPath(path):
+    """
+    Write the data of a closed file on the disk.
+    """
+    with open(path, 'rb+') as fileToSync: #Writable handle, needed by fsync on Windows
+        os.fsync(fileToSync.fileno())
+
+
+class IOService(object):
+    """
+    One long-lived thread doing the slow file operations (close, fsync,
+    rename, flush) out of the acquisition threads, in the order they were
+    submitted.
+    Each submit returns a concurrent.futures.Future, done when the work is
+    done (result or exception), a callback(future) can be given too.
+    The work queue is bounded : if the disk falls behind, submit blocks the
+    caller (back-pressure up to the frame pipeline) instead of letting the
+    pending work grow.
+    """
+
+    def __init__(self, queueSize=16):
+        self.queue = queue.Queue(maxsize=queueSize)
+        self.thread = None
+        self.nbDone = 0
+        self.nbErrors = 0
+        self.blockedTime = 0. #Total time (s) the callers waited for a free place in the queue
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the I/O thread (if not running).
+        """
+        with self._lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._loop, name='I/O service')
+                self.thread.daemon = True #Stopped by stop() (registered with atexit for the session service)
+                self.thread.start()
+        return self
+
+    def _loop(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                (future, function, args, callback) = item
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(function(*args))
+                    except Exception as e:
+                        print('I/O service error : ', e)
+                        self.nbErrors += 1
+                        future.set_exception(e)
+                    self.nbDone += 1
+                    if callback is not None:
+                        try:
+                            callback(future)
+                        except Exception as e:
+                            print('I/O service callback error : ', e)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queue function(*args) and return its Future. Blocks while the queue is
+        full. kwargs : callback(future) called by the I/O thread when done.
+        """
+        future = Future()
+        item = (future, function, args, kwargs.get('callback'))
+        self.start()
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            start = perf_counter()
+            self.queue.put(item) #Back-pressure
+            self.blockedTime += perf_counter()-start
+        return future
+
+    def close(self, fileObject, path=None, callback=None):
+        """
+        Close a file object (file, TiffWriter...). If path is given, the file
+        is written on the disk (fsync) once closed.
+        """
+        def closing(fileObject, path):
+            fileObject.close()
+            if path is not None:
+                fsyncPath(path)
+        return self.submit(closing, fileObject, path, callback=callback)
+
+    def flush(self, fileObject, sync=False, callback=None):
+        """
+        Flush the buffer of an open file object (and fsync it if sync).
+        The caller must not write in the file before the future is done.
+        """
+        def flushing(fileObject, sync):
+            fileObject.flush()
+            if sync:
+                os.fsync(fileObject.fileno())
+        return self.submit(flushing, fileObject, sync, callback=callback)
+
+    def fsync(self, path, callback=None):
+        """
+        Write the data of a closed file on the disk.
+        """
+        return self.submit(fsyncPath, path, callback=callback)
+
+    def rename(self, source, destination, callback=None):
+        """
+        Rename a file (replace the destination if it exists).
+        """
+        return self.submit(os.replace, source, destination, callback=callback)
+
+    def pending(self):
+        """
+        Return the nb of works waiting in the queue.
+        """
+        return self.queue.qsize()
+
+    def drain(self):
+        """
+        Wait until all the submitted work is done.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+
+    def stop(self):
+        """
+        Do the pending work and stop the I/O thread.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.thread = None
+        print('I/O service stopped, works done : ', self.nbDone, ' errors : ', self.nbErrors,
+              ' time blocked (s) : ', round(self.blockedTime, 3))
+
+
+def ioService():
+    """
+    Return the IOService of the session, created at the first call. Its
+    pending work is done before the interpreter exits.
+    """
+    global service
+    if service is None:
+        service = IOService()
+        atexit.register(service.stop)
+    return service
@@ -7,6 +7,9 @@ Created on Tue Aug 20 16:48:18 2019
 
 import u3
 from time import sleep
+from collections import namedtuple
+import numpy as np
+from waitFcts import waitUntil
 
 ##### TEST NEEDED #####
 import cv2
@@ -24,6 +27,23 @@ blue_lj = 4 #FIO7
 trig = 7 #FIO7 #Is high when any LED goes high
 cameraTrig_lj = 0    #AIN0
 
+#Thresholds (V) of the signals read on AIN
+ttlLevel = 2.4 #HIGH state of a TTL signal (FIRE, ARM, SYNC)
+ttlLowLevel = 0.8 #LOW state of a TTL signal, between both levels the state doesn't change
+valveLevel = 2.8 #Odour valve closed above this voltage
+
+#Time units (s) of the U3 WaitShort/WaitLong feedback commands (WaitShort, WaitLong)
+#by hardware revision, see waitUnits. A long unit is 256 short units on both.
+u3cWaitUnits = (0.000128, 0.032768) #U3C, hardware version 1.30
+u3bWaitUnits = (0.000064, 0.016384) #U3B, hardware version 1.20 and 1.21
+
+#Max time between 2 polls of a signal (s), small compared to the camera pulses
+pollMaxSleep = 0.0002
+
+#LabjackStream running on a device (id(device) : stream), AIN can't be read
+#with command-response while streaming
+activeStreams = {}
+
 
 ####USELESS###
 ## Boolean variable that will represent
@@ -32,7 +52,15 @@ cameraTrig_lj = 0    #AIN0
 
 ## establish connection to the serial port that your arduino
 ## is connected to.
-def labjackInit():
+def labjackInit(simulated=False, **simOptions):
+    """
+    Open the first U3 found, or a simulated U3 (see LabjackSim.LabjackSim,
+    simOptions are its arguments) if simulated.
+    """
+    if simulated:
+        from LabjackSim import LabjackSim
+        print('Simulated labjack device')
+        return LabjackSim(**simOptions)
     try:
         device = u3.U3() #Open first found U3
     except:
@@ -40,36 +68,228 @@ def labjackInit():
         print("Error : labjack device non available")
     return device
 
+class FeedbackBatch(object):
+    """
+    Group feedback commands (digital writes, AIN and FIO reads) to send them
+    to the U3 with getFeedback in as few USB transactions as possible, instead
+    of one command-response per setFIOState or getAIN.
+    The commands are executed in the order they were added, the batch is split
+    only when a packet would be bigger than 64 bytes. An atomic batch is never
+    split : ValueError if its commands don't fit in one transaction.
+    """
+    #Max nb of command and response bytes in one feedback packet
+    maxCommandBytes = 56
+    maxResponseBytes = 54
+
+    def __init__(self, device, atomic=False):
+        self.device = device
+        self.atomic = atomic #All the commands in one USB transaction (LED line + trig, timed pulse)
+        self.packets = [[]] #Lists of commands, one per transaction
+        self.reads = [] #(packet nb, command nb, channel type, channel) of each read
+        self.commandBytes = 0
+        self.responseBytes = 0
+
+    def _add(self, command, commandBytes, responseBytes):
+        if (self.commandBytes+commandBytes > FeedbackBatch.maxCommandBytes or
+                self.responseBytes+responseBytes > FeedbackBatch.maxResponseBytes):
+            if self.atomic:
+                raise ValueError('Feedback commands too big for one transaction, atomic batch not split')
+            self.packets.append([])
+            self.commandBytes = 0
+            self.responseBytes = 0
+        self.packets[-1].append(command)
+        self.commandBytes += commandBytes
+        self.responseBytes += responseBytes
+        return (len(self.packets)-1, len(self.packets[-1])-1)
+
+    def setFIO(self, channel, state):
+        """
+        Set a digital line as output with the given state (as setFIOState).
+        """
+        self._add(u3.BitDirWrite(channel, 1), 2, 0)
+        self._add(u3.BitStateWrite(channel, state), 2, 0)
+        return self
+
+    def wait(self, duration):
+        """
+        Make the U3 wait duration (s) before the next commands, timed by the
+        clock of the LabJack (resolution : WaitShort unit of the device, see
+        waitUnits).
+        Return the programmed duration (s).
+        """
+        (shortUnit, longUnit) = waitUnits(self.device)
+        shortPerLong = int(round(longUnit/shortUnit))
+        shortUnits = int(round(duration/shortUnit))
+        programmed = shortUnits*shortUnit
+        while shortUnits >= shortPerLong: #Long waits first to keep the packet small
+            longUnits = min(255, shortUnits//shortPerLong)
+            self._add(u3.WaitLong(longUnits), 2, 0)
+            shortUnits -= longUnits*shortPerLong
+        while shortUnits > 0:
+            self._add(u3.WaitShort(min(255, shortUnits)), 2, 0)
+            shortUnits -= min(255, shortUnits)
+        return programmed
+
+    def readAIN(self, channel):
+        """
+        Read a single ended AIN (V). Served from the stream if it is streamed.
+        """
+        stream = activeStreams.get(id(self.device))
+        if stream is not None and channel in stream.channels:
+            self.reads.append((None, None, "AIN", channel))
+        else:
+            (packetNb, commandNb) = self._add(u3.AIN(channel, 31), 3, 2)
+            self.reads.append((packetNb, commandNb, "AIN", channel))
+        return self
+
+    def readFIO(self, channel):
+        """
+        Read the state of a digital line.
+        """
+        (packetNb, commandNb) = self._add(u3.BitStateRead(channel), 2, 1)
+        self.reads.append((packetNb, commandNb, "FIO", channel))
+        return self
+
+    def readCounter(self, counterNb=0, reset=False):
+        """
+        Read a hardware counter of the U3 (reset after the read if reset).
+        """
+        (packetNb, commandNb) = self._add(u3.Counter(counterNb, reset), 2, 4)
+        self.reads.append((packetNb, commandNb, "Counter", counterNb))
+        return self
+
+    def execute(self):
+        """
+        Send the commands and return the values read, in the order of the reads.
+        """
+        results = [self.device.getFeedback(*packet) for packet in self.packets if packet]
+        values = []
+        for (packetNb, commandNb, channelType, channel) in self.reads:
+            if packetNb is None:
+                values.append(activeStreams[id(self.device)].latest(channel))
+            elif channelType == "AIN":
+                values.append(ainVoltage(self.device, results[packetNb][commandNb], channel))
+            else:
+                values.append(results[packetNb][commandNb])
+        return values
+
+def waitUnits(device):
+    """
+    Return the (WaitShort, WaitLong) time units (s) of a U3, from the
+    hardware version read when it was opened (U3C units if unknown).
+    """
+    try:
+        if float(device.hardwareVersion) < 1.30:
+            return u3bWaitUnits
+    except (AttributeError, TypeError, ValueError):
+        pass
+    return u3cWaitUnits
+
+def ainVoltage(device, bits, channel):
+    """
+    Convert the raw bits of a single ended AIN into a voltage (as getAIN).
+    """
+    lowVoltage = True
+    try:
+        if device.isHV and channel < 4: #AIN0-3 of the U3-HV are high voltage inputs
+            lowVoltage = False
+    except AttributeError:
+        pass
+    return device.binaryToCalibratedAnalogVoltage(bits, isLowVoltage=lowVoltage, isSingleEnded=True,
+                                                  isSpecialSetting=False, channelNumber=channel)
+
+#Record of the channels read in one transaction, the arrays follow the order of the channels
+#time : time() before the transaction, ain : voltages, fio : digital states,
+#ttl : ain > ttlLevel (0/1), valve : odour valve state of ain (see odourValveStates),
+#count : value of the counter read (None if no counter read)
+Snapshot = namedtuple('Snapshot', ['time', 'ainChannels', 'ain', 'fioChannels', 'fio', 'ttl', 'valve', 'count'])
+
+def readSnapshot(device, ainChannels=(), fioChannels=(), batch=None, counterNb=None):
+    """
+    Read a set of AIN and FIO channels (and a counter if counterNb is given)
+    in one feedback transaction (after the commands already in batch if
+    given) and return a Snapshot, all channels come from the same instant.
+    """
+    if batch is None:
+        batch = FeedbackBatch(device)
+    for channel in ainChannels:
+        batch.readAIN(channel)
+    for channel in fioChannels:
+        batch.readFIO(channel)
+    if counterNb is not None:
+        batch.readCounter(counterNb)
+    snapshotTime = time.time()
+    values = batch.execute()
+    ain = np.array(values[:len(ainChannels)], dtype=np.float64)
+    fio = np.array(values[len(ainChannels):len(ainChannels)+len(fioChannels)], dtype=np.int8)
+    count = values[-1] if counterNb is not None else None
+    return Snapshot(snapshotTime, tuple(ainChannels), ain, tuple(fioChannels), fio,
+                    ttlStates(ain), odourValveStates(ain), count)
+
+def ttlStates(voltages):
+    """
+    Convert voltages into TTL states : 1 if HIGH (>= ttlLevel), 0 otherwise.
+    """
+    return (np.asarray(voltages) >= ttlLevel).astype(np.int8)
+
+def odourValveStates(voltages):
+    """
+    Convert voltages of the odour valve signal into 1 if valve open (low
+    voltage) or 0 if valve close (high voltage)
+    """
+    return np.where(np.asarray(voltages) > valveLevel, 0, 1).astype(np.int8)
+
+def ledOn(device, led, ainChannels=()):
+    """
+    Switch on a LED line and the trig line in one transaction, then read the
+    AIN channels. Return the Snapshot of the channels read.
+    """
+    return readSnapshot(device, ainChannels, batch=FeedbackBatch(device, atomic=True).setFIO(led, 1).setFIO(trig, 1))
+
+def ledOff(device, led, ainChannels=()):
+    """
+    Switch off a LED line and the trig line in one transaction, then read the
+    AIN channels. Return the Snapshot of the channels read.
+    """
+    return readSnapshot(device, ainChannels, batch=FeedbackBatch(device, atomic=True).setFIO(led, 0).setFIO(trig, 0))
+
+def ledPulse(device, led, duration, ainChannels=()):
+    """
+    LED pulse timed by the LabJack : switch on the LED line and the trig
+    line, wait duration (s) on the U3 clock, switch them off and read the AIN
+    channels, all in one transaction. The pulse width doesn't depend on the
+    USB latency or on the Python threads.
+    Return (Snapshot of the channels read, programmed duration in s).
+    """
+    batch = FeedbackBatch(device, atomic=True).setFIO(led, 1).setFIO(trig, 1)
+    pulseDuration = batch.wait(duration)
+    batch.setFIO(led, 0).setFIO(trig, 0)
+    return (readSnapshot(device, ainChannels, batch=batch), pulseDuration)
+
 def greenOn(device):
     #print "green ON"
-    device.setFIOState(green_lj, 1)
-    device.setFIOState(trig, 1)
+    ledOn(device, green_lj)
 
 def greenOff(device):
     #print "green OFF"
-    device.setFIOState(green_lj, 0)
-    device.setFIOState(trig, 0)
+    ledOff(device, green_lj)
 
 
 def redOn(device):
     #print "red ON"
-    device.setFIOState(red_lj, 1)
-    device.setFIOState(trig, 1)
+    ledOn(device, red_lj)
 
 def redOff(device):
     #print "red OFF"
-    device.setFIOState(red_lj, 0)
-    device.setFIOState(trig, 0)
+    ledOff(device, red_lj)
 
 def blueOn(device):
     #print "red ON"
-    device.setFIOState(blue_lj, 1)
-    device.setFIOState(trig, 1)
+    ledOn(device, blue_lj)
 
 def blueOff(device):
     #print "red OFF"
-    device.setFIOState(blue_lj, 0)
-    device.setFIOState(trig, 0)
+    ledOff(device, blue_lj)
 
 def trigExposure(device, exp):
     print('pulse generation')
@@ -88,7 +308,7 @@ def trigImage(device):
     device.setFIOState(trig, 0)
 
 
-def waitForSignal(device, signalType="TTL", channelType="AIN", channel=1):
+def waitForSignal(device, signalType="TTL", channelType="AIN", channel=1, timeout=None, stopEvent=None):
     """
     Wait for a signal into the LabJack
 
@@ -102,32 +322,54 @@ def waitForSignal(device, signalType="TTL", channelType="AIN", channel=1):
 
     channel: int, default = 3
         Sets the channel of `channelType` to listen on.
+
+    timeout: float, default = None
+        Max waiting time (s), None to wait until the signal comes.
+
+    stopEvent: threading.Event, default = None
+        Interrupt the waiting when set.
+
+    return True when the signal is detected, False if timed out or stopped.
     """
     trigger = False
     if channelType == "FIO": ##Use a DIGITAL input
-        while device.getDIState(channel) == 0:
-            continue
-        trigger = True
+        trigger = waitUntil(lambda: device.getDIState(channel) != 0,
+                            timeout, pollMaxSleep, stopEvent)
 
     elif channelType == "AIN": ####Use a ANALOG input
         #print "WARNING: This might not work as expected, AIN mode still experimental." #NoWay
         if signalType == "TTL":
             targetVoltage = 3
-        while (device.getAIN(channel) - targetVoltage) < 0:
-            continue
-        trigger = True
+        trigger = waitUntil(lambda: (device.getAIN(channel) - targetVoltage) >= 0,
+                            timeout, pollMaxSleep, stopEvent)
     else:
-        raise "Error: channelType: {wrongType} not recognised".format(wrongType=channelType)
+        raise ValueError("Error: channelType: {wrongType} not recognised".format(wrongType=channelType))
 
     return trigger
 
+def registerStream(device, stream):
+    """
+    Flag that a LabjackStream is running on the device.
+    """
+    activeStreams[id(device)] = stream
+
+def unregisterStream(device):
+    """
+    Flag that no LabjackStream is running on the device.
+    """
+    activeStreams.pop(id(device), None)
+
 def readSignal(device, channel):
     """
     Read a signal coming into the LabJack (AIN)
+    If the channel is streamed, return its newest sample.
 
     channel: int, default = 3
         Sets the channel of `channelType` to listen on.
     """
+    stream = activeStreams.get(id(device))
+    if stream is not None and channel in stream.channels:
+        return stream.latest(channel)
     try:
         sigValue = device.getAIN(channel)
     except:
@@ -138,53 +380,53 @@ def readOdourValve(device, channel):
     """
     Converted signal read into 1 if valve open (low voltage) or valve close (high voltage)
     """
-    valveState=None
-    sigValue = readSignal(device, channel)
-    if sigValue>2.8:
-        valveState=0
-    else :
-        valveState=1
-    return valveState
+    return odourValveState(readSignal(device, channel))
+
+def odourValveState(sigValue):
+    """
+    Convert a voltage of the odour valve signal into 1 if valve open (low
+    voltage) or 0 if valve close (high voltage)
+    """
+    return int(odourValveStates(sigValue))
 
 
 
-def risingEdge(device, lj_channel, timeout=0.5):
+def risingEdge(device, lj_channel, timeout=0.5, stopEvent=None):
     """
     Wait for a rising edge (minimum %trigLevel V) into the LabJack AIN0 port (cameraTrig_lj variable)
 
     return True when the risingedge is detected.
     """
-    trigLevel = 2.4
+    trigLevel = ttlLevel
     rEdge = False
 
     #if (device.getAIN(cameraTrig_lj) > trigLevel):
         #print 'High state, cant wait for rising'
     if(device.getAIN(lj_channel) < trigLevel): # Check that the signal is in low state
-        timeoutCounter=time.time()
-        rEdge = True
-        while (device.getAIN(lj_channel) < trigLevel) and rEdge: #get out of this loop only when a high state is detected
-            if ((time.time()-timeoutCounter)>timeout):
-                print('rising edge detection timed out')
-                rEdge=False
+        #get out of the waiting only when a high state is detected
+        rEdge = waitUntil(lambda: device.getAIN(lj_channel) >= trigLevel,
+                          timeout, pollMaxSleep, stopEvent)
+        if not rEdge and (stopEvent is None or not stopEvent.is_set()):
+            print('rising edge detection timed out')
 
     return rEdge
 
-def fallingEdge(device, lj_channel):
+def fallingEdge(device, lj_channel, timeout=None, stopEvent=None):
     """
     Wait for a falling edge (maximum %trigLevel V) into the LabJack AIN0 port (cameraTrig_lj variable)
 
     return True when the risingedge is detected.
     """
-    trigLevel = 0.5
+    trigLevel = ttlLowLevel
     fEdge = False
 
 #    if (device.getAIN(cameraTrig_lj) < trigLevel):
 #        print 'Low state, cant wait for falling'
     if(device.getAIN(lj_channel) > trigLevel): # Check that the signal is in high state
-        while (device.getAIN(lj_channel) > trigLevel): #get out of this loop only when a low state is detected
-            continue
+        #get out of the waiting only when a low state is detected
+        fEdge = waitUntil(lambda: device.getAIN(lj_channel) <= trigLevel,
+                          timeout, pollMaxSleep, stopEvent)
         #print 'falling Edge detected'
-        fEdge = True
 
     return fEdge
 
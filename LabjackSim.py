@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 26 09:18:44 2026
+
+@author: Johnstonlab
+
+Simulated LabJack U3-HV playing back scripted or recorded waveforms, to run
+the acquisition code and its benchmarks without the rig.
+Use Labjack.labjackInit(simulated=True) to get one.
+"""
+#Packages import
+import threading
+import time
+from collections import deque
+import numpy as np
+import u3
+
+#Variables import
+from Labjack import ttlLevel, ttlLowLevel, waitUnits
+
+
+### Waveforms : function of an array of times (s since the device creation) returning the voltages
+
+def constantWave(level):
+    """
+    Constant voltage.
+    """
+    return lambda t: np.full(np.shape(t), float(level))
+
+def squareWave(period, highTime, high=5., low=0., delay=0.):
+    """
+    TTL pulses of highTime (s) every period (s), the first one at delay (s).
+    Before the first pulse the signal is low.
+    """
+    def wave(t):
+        t = np.asarray(t, dtype=np.float64)-delay
+        return np.where((t >= 0) & (np.mod(t, period) < highTime), high, low)
+    return wave
+
+def sineWave(frequency, amplitude=1., offset=2.5):
+    """
+    Sine wave (respiration like signal).
+    """
+    return lambda t: offset+amplitude*np.sin(2*np.pi*frequency*np.asarray(t, dtype=np.float64))
+
+def scriptedWave(times, levels, period=None):
+    """
+    Steps : levels[i] from times[i] (s) to times[i+1], levels[0] before
+    times[0]. The script is repeated every period (s) if given.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    levels = np.asarray(levels, dtype=np.float64)
+    def wave(t):
+        t = np.asarray(t, dtype=np.float64)
+        if period is not None:
+            t = np.mod(t, period)
+        return levels[np.clip(np.searchsorted(times, t, side='right')-1, 0, len(levels)-1)]
+    return wave
+
+def recordedWave(samples, sampleRate, loop=True):
+    """
+    Playback of recorded samples (ex : respiration column of
+    RespirationRecorder.respirationLoading) at sampleRate (Hz), linear
+    interpolation between the samples. The recording is looped if loop, else
+    the last sample is kept.
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    duration = len(samples)/float(sampleRate)
+    sampleTimes = np.arange(len(samples))/float(sampleRate)
+    def wave(t):
+        t = np.asarray(t, dtype=np.float64)
+        if loop:
+            t = np.mod(t, duration)
+        return np.interp(t, sampleTimes, samples)
+    return wave
+
+def rigWaveforms(frameRate=50., exposure=0.01, respirationRate=2., stimPeriod=20., stimDuration=10.,
+                 stimDelay=1., valveDelay=3., valveDuration=2., armChannel=None):
+    """
+    Waveforms of the rig wiring (see SequenceAcquisition) :
+        - AIN0 : respiration, sine at respirationRate (Hz)
+        - AIN1 : SYNC of the stimulator, HIGH for stimDuration (s) every
+          stimPeriod (s) from stimDelay (s)
+        - AIN2 : odour valve, LOW (open) for valveDuration (s) valveDelay (s)
+          after each SYNC rising edge, HIGH (closed) otherwise
+        - AIN3 : camera FIRE, HIGH during the exposure (s) of each frame
+        - armChannel : camera ARM if given, HIGH when the camera is not exposing
+    Return a dictionary {AIN channel : waveform}.
+    """
+    waveforms = {0: sineWave(respirationRate),
+                 1: squareWave(stimPeriod, stimDuration, delay=stimDelay),
+                 2: squareWave(stimPeriod, valveDuration, high=0., low=5., delay=stimDelay+valveDelay),
+                 3: squareWave(1./frameRate, exposure)}
+    if armChannel is not None:
+        waveforms[armChannel] = squareWave(1./frameRate, 1./frameRate-exposure, delay=exposure)
+    return waveforms
+
+
+class LabjackSim(object):
+    """
+    Drop-in replacement of u3.U3 for the calls of this software : getAIN,
+    getDIState, setFIOState, configIO, getFeedback (BitDirWrite,
+    BitStateWrite, BitStateRead, AIN, Counter, WaitShort, WaitLong),
+    binaryToCalibratedAnalogVoltage and the stream (streamConfig,
+    streamStart, streamData, streamStop).
+    --> Simulation :
+        - AIN channels play the waveforms (see rigWaveforms), with a gaussian
+          noise (V) if given, and are quantized on 16 bits as the U3-HV
+          (AIN0-3 : +/-10.3V, others : 0-2.44V).
+        - Each command-response transaction takes latency (s) (USB round
+          trip), transactions of several threads are serialized as on the USB
+          pipe. The waits of a feedback packet are added to its duration.
+        - Counters count the rising edges of the waveform of counterChannel
+          (FIRE wired on AIN3 and on the counter pin).
+        - The digital writes are logged with their time in fioLog.
+        - AIN can't be read with command-response while streaming.
+    """
+
+    #Range of the AIN on 16 bits (offset, span), U3-HV
+    hvRange = (-10.3, 20.6)
+    lvRange = (0., 2.44)
+
+    def __init__(self, waveforms=None, latency=0.001, noise=0., counterChannel=3,
+                 counterResolution=20000., isHV=True, logSize=100000, hardwareVersion='1.30'):
+        self.waveforms = rigWaveforms() if waveforms is None else dict(waveforms)
+        self.latency = latency
+        self.noise = noise
+        self.counterChannel = counterChannel
+        self.counterResolution = counterResolution #Sampling rate (Hz) of the counted waveform
+        self.isHV = isHV
+        self.deviceName = 'U3-HV (simulated)' if isHV else 'U3-LV (simulated)'
+        self.hardwareVersion = hardwareVersion #1.30 : U3C, 1.20 or 1.21 : U3B (units of the waits)
+        self.startTime = time.perf_counter()
+
+        self.fioDirections = {} #IO number : 1 output, 0 input
+        self.fioStates = {} #IO number : state written
+        self.fioLog = deque(maxlen=logSize) #(time, IO number, state) of each digital write
+        self.ioConfig = {'TimerCounterPinOffset': 4, 'EnableCounter0': False,
+                         'EnableCounter1': False, 'NumberOfTimersEnabled': 0}
+        self.counters = {} #Counter nb : [count, last time counted (s), last level]
+        self.nbTransactions = 0
+
+        self.streamStarted = False
+        self.streamChannels = []
+        self.scanFrequency = None
+        self.streamSamplesPerPacket = 25
+        self.packetsPerRequest = 48
+        self._lock = threading.Lock()
+
+    def now(self):
+        """
+        Time of the simulation (s since the device creation).
+        """
+        return time.perf_counter()-self.startTime
+
+    def close(self):
+        self.streamStarted = False
+
+    ### Signals ###
+    def _voltages(self, channel, t):
+        wave = self.waveforms.get(channel)
+        if wave is None:
+            voltages = np.zeros(np.shape(t))
+        else:
+            voltages = wave(t)
+        if self.noise:
+            voltages = voltages+np.random.normal(0., self.noise, np.shape(voltages))
+        return voltages
+
+    def _range(self, channel):
+        return LabjackSim.hvRange if (self.isHV and channel < 4) else LabjackSim.lvRange
+
+    def _bits(self, channel, t):
+        """
+        16 bits reading of an AIN at the time t (s).
+        """
+        (offset, span) = self._range(channel)
+        return int(np.clip(round((float(self._voltages(channel, t))-offset)/span*65535), 0, 65535))
+
+    def binaryToCalibratedAnalogVoltage(self, bits, isLowVoltage=True, isSingleEnded=True,
+                                        isSpecialSetting=False, channelNumber=0):
+        (offset, span) = LabjackSim.lvRange if isLowVoltage else LabjackSim.hvRange
+        return bits*span/65535.+offset
+
+    def _count(self, counterNb, t, reset):
+        """
+        Count the rising edges of the counted waveform until t (s).
+        Return the count (before the reset if reset).
+        """
+        counter = self.counters.get(counterNb)
+        if counter is None:
+            return 0
+        (count, lastTime, lastLevel) = counter
+        step = 1./self.counterResolution
+        while lastTime+step <= t:
+            nbSamples = int(min((t-lastTime)/step, 1000000))
+            levels = self._voltages(self.counterChannel, lastTime+step*np.arange(1, nbSamples+1)) >= ttlLevel
+            count += int(np.count_nonzero(levels & ~np.concatenate(([lastLevel], levels[:-1]))))
+            lastLevel = bool(levels[-1])
+            lastTime += nbSamples*step
+        self.counters[counterNb] = [0 if reset else count, lastTime, lastLevel]
+        return count
+
+    def _counterStart(self, counterNb, t):
+        self.counters[counterNb] = [0, t, bool(self._voltages(self.counterChannel, t) >= ttlLevel)]
+
+    ### Command-response ###
+    def _transaction(self, duration=0.):
+        """
+        Wait the end of a USB transaction started at the call.
+        """
+        end = time.perf_counter()+self.latency+duration
+        self.nbTransactions += 1
+        remaining = end-time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def _checkNotStreaming(self):
+        if self.streamStarted:
+            raise u3.LabJackException('AIN command-response not available while streaming (simulated U3)')
+
+    def _writeFIO(self, ioNumber, state, t):
+        self.fioStates[ioNumber] = int(bool(state))
+        self.fioLog.append((t, ioNumber, int(bool(state))))
+
+    def getFeedback(self, *commandlist):
+        """
+        Run the feedback commands in order, the time of each command includes
+        the waits before it. Return the list of the results (None for the
+        writes and waits).
+        """
+        if len(commandlist) == 1 and isinstance(commandlist[0], list):
+            commandlist = commandlist[0]
+        with self._lock:
+            start = self.now()
+            t = start+self.latency/2 #Commands run when the packet reaches the U3
+            results = []
+            for command in commandlist:
+                name = type(command).__name__
+                result = None
+                if name == 'AIN':
+                    self._checkNotStreaming()
+                    result = self._bits(command.positiveChannel, t)
+                elif name == 'BitDirWrite':
+                    self.fioDirections[command.ioNumber] = int(bool(command.direction))
+                elif name == 'BitStateWrite':
+                    self._writeFIO(command.ioNumber, command.state, t)
+                elif name == 'BitStateRead':
+                    result = self.fioStates.get(command.ioNumber, 0)
+                elif name in ('Counter', 'Counter0', 'Counter1'):
+                    result = self._count(command.counter, t, command.reset)
+                elif name == 'WaitShort':
+                    t += command.time*waitUnits(self)[0]
+                elif name == 'WaitLong':
+                    t += command.time*waitUnits(self)[1]
+                else:
+                    raise u3.LabJackException('Feedback command not simulated : %s' % name)
+                results.append(result)
+            self._transaction(t-start-self.latency/2)
+        return results
+
+    def getAIN(self, posChannel, negChannel=31, longSettle=False, quickSample=False):
+        self._checkNotStreaming()
+        bits = self.getFeedback(u3.AIN(posChannel, negChannel, longSettle, quickSample))[0]
+        return self.binaryToCalibratedAnalogVoltage(bits, isLowVoltage=(self._range(posChannel) == LabjackSim.lvRange),
+                                                    channelNumber=posChannel)
+
+    def getDIState(self, ioNum):
+        return self.getFeedback(u3.BitDirWrite(ioNum, 0), u3.BitStateRead(ioNum))[1]
+
+    def setFIOState(self, fioNum, state=1):
+        self.getFeedback(u3.BitDirWrite(fioNum, 1), u3.BitStateWrite(fioNum, state))
+
+    def configIO(self, TimerCounterPinOffset=None, EnableCounter1=None, EnableCounter0=None,
+                 NumberOfTimersEnabled=None, FIOAnalog=None, EIOAnalog=None, EnableUART=None):
+        with self._lock:
+            t = self.now()
+            for (key, value) in (('TimerCounterPinOffset', TimerCounterPinOffset),
+                                 ('EnableCounter0', EnableCounter0),
+                                 ('EnableCounter1', EnableCounter1),
+                                 ('NumberOfTimersEnabled', NumberOfTimersEnabled)):
+                if value is not None:
+                    self.ioConfig[key] = value
+            for counterNb in (0, 1):
+                if not self.ioConfig['EnableCounter%d' % counterNb]:
+                    self.counters.pop(counterNb, None)
+                elif counterNb not in self.counters:
+                    self._counterStart(counterNb, t)
+            self._transaction()
+            return dict(self.ioConfig)
+
+    ### Stream ###
+    def streamConfig(self, NumChannels=1, SamplesPerPacket=25, InternalStreamClockFrequency=0,
+                     DivideClockBy256=False, Resolution=3, ScanInterval=1, PChannels=[30],
+                     NChannels=[31], ScanFrequency=None, SampleFrequency=None):
+        self.streamChannels = list(PChannels)[:NumChannels]
+        self.streamSamplesPerPacket = SamplesPerPacket
+        if ScanFrequency is None:
+            ScanFrequency = SampleFrequency/float(NumChannels)
+        self.scanFrequency = float(ScanFrequency)
+        self._transaction()
+
+    def streamStart(self):
+        self._transaction()
+        self.streamStartTime = self.now()
+        self.streamStarted = True
+
+    def streamData(self, convert=True):
+        """
+        Yield a dictionary of samples (AINi lists) each time a request worth
+        of packets (packetsPerRequest) was sampled, as the U3 stream.
+        """
+        if not self.streamStarted:
+            raise u3.LabJackException("Stream has not been started. Configure and start streaming before reading stream data.")
+        nbScans = max(1, self.streamSamplesPerPacket*self.packetsPerRequest//len(self.streamChannels))
+        scanCount = 0
+        while self.streamStarted:
+            blockEnd = self.streamStartTime+(scanCount+nbScans)/self.scanFrequency
+            waitTime = blockEnd-self.now()
+            if waitTime > 0:
+                time.sleep(waitTime)
+            scanTimes = self.streamStartTime+(scanCount+np.arange(nbScans))/self.scanFrequency
+            result = {'errors': 0, 'missed': 0, 'firstPacket': 0,
+                      'numPackets': self.packetsPerRequest}
+            for channel in self.streamChannels:
+                result['AIN%d' % channel] = list(self._voltages(channel, scanTimes))
+            scanCount += nbScans
+            yield result
+
+    def streamStop(self):
+        self.streamStarted = False
+        self._transaction()
+
+
+###TEST SECTION :
+
+if __name__ == '__main__':
+    from Labjack import readSnapshot, ledPulse, blue_lj, FeedbackBatch
+    from FrameCounter import FrameCounter
+    device = LabjackSim(latency=0.001)
+    nbReads = 500
+    start = time.perf_counter()
+    for i in range(nbReads):
+        snapshot = readSnapshot(device, (2, 0, 1, 3))
+    print('readSnapshot (4 AIN) : ', round((time.perf_counter()-start)/nbReads*1000, 3), ' ms')
+    (snapshot, pulseDuration) = ledPulse(device, blue_lj, 0.01)
+    pulseLog = [entry for entry in device.fioLog if entry[1] == blue_lj]
+    print('LED pulse programmed : ', pulseDuration, ' simulated : ', round(pulseLog[-1][0]-pulseLog[-2][0], 6))
+    #Wait units of both revisions (U3 user's guide) : a WaitLong is 256 WaitShort
+    assert waitUnits(device) == (0.000128, 0.032768), 'U3C wait units'
+    assert waitUnits(LabjackSim(hardwareVersion='1.21')) == (0.000064, 0.016384), 'U3B wait units'
+    for version in ('1.30', '1.21'):
+        revisionDevice = LabjackSim(hardwareVersion=version)
+        (shortUnit, longUnit) = waitUnits(revisionDevice)
+        assert abs(longUnit/shortUnit-256.) < 1e-9, 'WaitLong/WaitShort ratio of hardware '+version
+        #Pulse longer than 255 short waits : long and short waits mixed
+        batch = FeedbackBatch(revisionDevice).setFIO(blue_lj, 1)
+        programmed = batch.wait(0.05)
+        waited = sum([command.time*(longUnit if type(command).__name__ == 'WaitLong' else shortUnit)
+                      for command in batch.packets[0] if type(command).__name__ in ('WaitShort', 'WaitLong')])
+        assert abs(waited-programmed) < 1e-9 and abs(programmed-0.05) <= shortUnit/2, 'Wait of hardware '+version
+    #An atomic batch is never split in several transactions
+    try:
+        readSnapshot(device, list(range(16))*2, batch=FeedbackBatch(device, atomic=True).setFIO(blue_lj, 1))
+        raise AssertionError('atomic batch split')
+    except ValueError:
+        pass
+    frameCounter = FrameCounter(device)
+    frameCounter.start()
+    time.sleep(1.)
+    print('FIRE pulses counted in 1 s : ', frameCounter.read().count)
+    frameCounter.stop()
+    #Respiration streamed (respirationRecording) : AIN polling is rejected,
+    #the FIRE edges must come from the stream (SequenceAcquisition._metadataSavingStream)
+    from Labjack import risingEdge
+    from LabjackStream import LabjackStream
+    from EdgeDetector import EdgeDetector
+    stream = LabjackStream(device)
+    stream.start()
+    try:
+        risingEdge(device, 3, timeout=0.1)
+        raise AssertionError('AIN polled while streaming')
+    except u3.LabJackException:
+        pass
+    fireDetector = EdgeDetector(stream.scanFrequency, ttlLevel, ttlLowLevel)
+    stream.waitForSamples(int(stream.scanFrequency), 2.)
+    (firstSample, block) = stream.window(0)
+    (edgeSamples, edgeTimes) = fireDetector.process(firstSample, block[stream.row(3)])
+    stream.stop()
+    assert abs(len(edgeSamples)-block.shape[1]/stream.scanFrequency*50.) <= 2, 'FIRE edges not found in the stream'
+    print('FIRE edges in the stream : ', len(edgeSamples), ' in ', block.shape[1]/stream.scanFrequency, ' s')
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 09:32:47 2026
+
+@author: Johnstonlab
+
+Class of the LabJack stream capture engine.
+"""
+#Packages import
+import threading
+from time import time
+import numpy as np
+
+#Function import
+from Labjack import registerStream, unregisterStream
+
+
+class LabjackStream(object):
+    """
+    Capture engine using the stream mode of the U3.
+    The AIN channels are sampled continuously by the LabJack at a fixed
+    hardware rate, a dedicated thread copies the samples into a ring buffer.
+    The metadata of each frame is taken from this buffer instead of being
+    read with one USB command-response per channel and per frame.
+    Sample i of a channel was acquired at i/scanFrequency (s) after the
+    start of the stream.
+    NB : while streaming, the U3 can't read AIN with command-response, other
+    functions should read the signals with Labjack.readSignal (served from the
+    buffer when the stream is running).
+    """
+
+    def __init__(self, device, channels=(3,2,0,1), scanFrequency=2500, bufferSeconds=10., resolution=3):
+        self.device = device
+        self.channels = list(channels) #AIN channels streamed, in order
+        self.scanFrequency = scanFrequency #Scans per second (one sample per channel per scan)
+        self.resolution = resolution
+        self.capacity = int(scanFrequency*bufferSeconds)
+        self.buffer = np.zeros((len(self.channels), self.capacity), dtype=np.float32)
+
+        self.sampleCount = 0 #Total nb of scans written in the buffer
+        self.missedCount = 0 #Nb of scans missed by the LabJack (filled with NaN)
+        self.startTime = None #time() of the stream start
+        self.running = False
+        self.listeners = []
+        self._thread = None
+        self._newSamples = threading.Condition()
+
+    def row(self, channel):
+        """
+        Return the row of an AIN channel in the buffer.
+        """
+        return self.channels.index(channel)
+
+    def addListener(self, callback):
+        """
+        callback(firstSample, block) is called by the capture thread for each
+        new block of samples, block is a (nbChannels, N) array.
+        """
+        self.listeners.append(callback)
+
+    def start(self):
+        """
+        Configure and start the stream, then start the capture thread.
+        """
+        self.device.streamConfig(NumChannels=len(self.channels),
+                                 PChannels=self.channels,
+                                 NChannels=[31]*len(self.channels), #Single ended
+                                 Resolution=self.resolution,
+                                 ScanFrequency=self.scanFrequency)
+        self.sampleCount = 0
+        self.missedCount = 0
+        self.running = True
+        self.device.streamStart()
+        self.startTime = time()
+        registerStream(self.device, self)
+        self._thread = threading.Thread(target=self._captureLoop)
+        self._thread.daemon = True
+        self._thread.start()
+        print('LabJack stream started at ', self.scanFrequency, ' Hz on AIN', self.channels)
+
+    def _captureLoop(self):
+        """
+        Capture thread : copy each block of the stream in the ring buffer.
+        """
+        try:
+            for result in self.device.streamData():
+                if not self.running:
+                    break
+                if result is None: #No data yet
+                    continue
+                if result['missed']:
+                    missedScans = int(result['missed']/len(self.channels))
+                    self.missedCount += missedScans
+                    print('LabJack stream : ', missedScans, ' scans missed')
+                    self._append(np.full((len(self.channels), missedScans), np.nan, dtype=np.float32))
+                nbScans = min([len(result['AIN%d' % channel]) for channel in self.channels])
+                block = np.array([result['AIN%d' % channel][:nbScans] for channel in self.channels], dtype=np.float32)
+                self._append(block)
+        except Exception as e:
+            print('LabJack stream error : ', e)
+        finally:
+            self.running = False
+            with self._newSamples:
+                self._newSamples.notify_all()
+            try:
+                self.device.streamStop()
+            except Exception as e:
+                print('LabJack stream stop error : ', e)
+
+    def _append(self, block):
+        """
+        Write a block of samples in the ring buffer and wake up the readers.
+        """
+        nbScans = block.shape[1]
+        if nbScans == 0:
+            return
+        firstSample = self.sampleCount
+        if nbScans > self.capacity: #Keep only the newest samples
+            block = block[:, -self.capacity:]
+            firstSample += nbScans-self.capacity
+        start = firstSample % self.capacity
+        stop = start+block.shape[1]
+        if stop <= self.capacity:
+            self.buffer[:, start:stop] = block
+        else:
+            split = self.capacity-start
+            self.buffer[:, start:] = block[:, :split]
+            self.buffer[:, :stop-self.capacity] = block[:, split:]
+        with self._newSamples:
+            self.sampleCount += nbScans
+            self._newSamples.notify_all()
+        for callback in self.listeners:
+            callback(firstSample, block)
+
+    def waitForSamples(self, sampleIndex, timeout=None):
+        """
+        Wait until the sample sampleIndex is in the buffer.
+        Return False if timed out or if the stream stopped.
+        """
+        with self._newSamples:
+            return self._newSamples.wait_for(lambda: (self.sampleCount > sampleIndex) or (not self.running), timeout) and self.sampleCount > sampleIndex
+
+    def window(self, firstSample, stopSample=None):
+        """
+        Return (firstSample, copy of the samples [firstSample, stopSample[)).
+        firstSample is moved forward if its samples were overwritten.
+        """
+        if stopSample is None:
+            stopSample = self.sampleCount
+        firstSample = max(firstSample, stopSample-self.capacity, 0)
+        if stopSample <= firstSample:
+            return (firstSample, np.empty((len(self.channels), 0), dtype=np.float32))
+        indexes = np.arange(firstSample, stopSample) % self.capacity
+        return (firstSample, self.buffer[:, indexes])
+
+    def latest(self, channel):
+        """
+        Return the newest sample of an AIN channel.
+        """
+        if self.sampleCount == 0:
+            return float('nan')
+        return float(self.buffer[self.row(channel), (self.sampleCount-1) % self.capacity])
+
+    def sampleTime(self, sampleIndex):
+        """
+        Return the time of a sample (s since stream start).
+        """
+        return float(sampleIndex)/self.scanFrequency
+
+    def stop(self):
+        """
+        Stop the capture thread and the stream.
+        """
+        self.running = False
+        if self._thread is not None:
+            self._thread.join(2.)
+            self._thread = None
+        unregisterStream(self.device)
+        print('LabJack stream stopped, scans : ', self.sampleCount, ' missed : ', self.missedCount)
@@ -27,16 +27,17 @@ import shutil
 #Class import
 from SequenceAcquisition import SequenceAcquisition
 from SignalInterrupt import SignalInterrupt
-from ArduinoTeensy import Arduino
+from ArduinoTeensy import cyclopsRegistry, synchronization
 from OdourMap import OdourMap
 from LiveHistogram import LiveHistogram
+from OmmiContainer import OmmiContainer, containerPath
 
 #Function import
 from crop import crop_w_mouse
 from camInit import camInit, defaultCameraSettings
 from saveFcts import fileSizeCalculation, jsonFileLoading
 from Labjack import labjackInit
-from ParsingFiles import load2DArrayFromTxt, get_immediate_subdirectories, getTifLists, splitColorChannel, getTxtList
+from ParsingFiles import load2DArrayFromTxt, get_immediate_subdirectories, getTifLists, splitColorChannel, getTxtList, txtFileSizeCorrection, moveChannelFiles
 #from ArduinoComm import connect, sendExposure, sendLedList, close
 
 
@@ -417,15 +418,14 @@ class OMMIwindow(QtWidgets.QMainWindow):
                        round(exp*(self.bExpRatio.value()),3)]
         #driverList = []
         for driverNb in ledDriverNb:
-            #driver init
-            driver = Arduino(driverNb)
+            #driver kept open by the registry
+            driver = cyclopsRegistry().driver(driverNb)
             #driverList.append(driver)
-            if driver.isConnected():
+            if driver is not None:
                 if color is None:
                     driver.ledOff()
                 else:
                     driver.oneColor(color,illumTimeList)
-                driver.closeConn()
 
     def green(self,toggle_g):
         """
@@ -660,25 +660,17 @@ class OMMIwindow(QtWidgets.QMainWindow):
 
 
 
-        #Arduino sync via ArduinoTeensy package
+        #Arduino sync via ArduinoTeensy package, all the drivers in parallel
         if self.rgbMode.isChecked():
             print('rgbMode call')
-            ledDriverNb=[0,1,2] #[Red, Green, Blue]
-            for driverNb in ledDriverNb:
-                #driver init
-                driver = Arduino(driverNb)
-                driver.synchronization(illumTime,
-                                       rgbLedRatio = rgbLedRatio)
+            synchronization(illumTime,
+                            rgbLedRatio = rgbLedRatio)
 
         elif self.rbMode.isChecked():
             print('rbMode call')
-            ledDriverNb=[0,1,2] #[Red, Green, Blue]
-            for driverNb in ledDriverNb:
-                #driver init
-                driver = Arduino(driverNb)
-                driver.synchronization(illumTime,
-                                       greenFrameInterval = greenFrameInterval,
-                                       colorMode = colorMode)
+            synchronization(illumTime,
+                            greenFrameInterval = greenFrameInterval,
+                            colorMode = colorMode)
 
 
     ######################################
@@ -987,11 +979,22 @@ class OMMIwindow(QtWidgets.QMainWindow):
         #print experimentFolderPath
         filePath =filesFolder+'/'+filesName
         print(filePath)
+        if moveChannelFiles(filesName, filesFolder, processedFolderPath):
+            print('channels split during the acquisition, files moved in : ', processedFolderPath)
+            return
+        if path.isdir(containerPath(filesFolder, filesName)):
+            print('exporting the OMMI container : ', OmmiContainer(containerPath(filesFolder, filesName)).exportTiff(processedFolderPath))
+            return
         txtFile=filePath+'.txt'
         try:
             txtArray = load2DArrayFromTxt(txtFile,"\t")
         except:
             print('error to convert txt to array')
+        if path.isfile(filePath+'_records.tsv'):
+            try:
+                txtArray = txtFileSizeCorrection(txtArray, filePath+'_records.tsv')
+            except:
+                print('error to align metadata with the frame records')
         try:
             tifsPathList = getTifLists(filesFolder, filesName)
             print(tifsPathList)
@@ -1213,6 +1216,7 @@ class OMMIwindow(QtWidgets.QMainWindow):
                 time.sleep(2) #Ensure all is well closed
             except:
                 print('No sequenceAcqu running or impossible to abort it')
+            cyclopsRegistry().closeAll() #Close the connections to the LED drivers
             self.unloadDevices()
             event.accept() # let the window close
         else:
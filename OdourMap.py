@@ -297,7 +297,7 @@ class OdourMap(QThread):
             color=0
             odMapList = []
             for tif in self.redTifs:
-                tifArray = tifffile.imread(tif)
+                tifArray = ParsingFiles.tifStack(tif) #Memory mapped if contiguous
                 if len(tifArray.shape) == 3 :
                     print('processing of : ', tif)
                     tifName = tif[:-4]
@@ -312,7 +312,7 @@ class OdourMap(QThread):
             color=1
             odMapList = []
             for tif in self.blueTifs:
-                tifArray = tifffile.imread(tif)
+                tifArray = ParsingFiles.tifStack(tif) #Memory mapped if contiguous
                 if len(tifArray.shape) == 3 :
                     print('processing of : ', tif)
                     tifName = tif[:-4]
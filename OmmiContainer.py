@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Nov 01 14:26:50 2026
+
+@author: Johnstonlab
+
+OMMI container : native storage of an acquisition (NumPy and standard library
+only), written by the acquisition pipeline and read without parsing.
+--> Layout of a container (folder name.ommi) :
+    - header.json : frame shape and dtype, frames per chunk, channels and
+      dtype of the index records. Written once, at the first frame.
+    - R_000000.raw, R_000001.raw... : raw frames of each channel (R, G, B),
+      chunkFrames frames per file, one after the other.
+    - index.bin : one fixed-size record per frame saved (indexDtype), in the
+      order of the frames : record n is the frame n written (frames not
+      saved, error of the writer, have no record).
+--> Files are only appended : after a crash, the whole frames and records on
+the disk are read, a record pointing to a frame not on the disk is ignored
+(see OmmiContainer.repair to truncate the files).
+"""
+#Packages import
+import os
+import json
+import time
+import shutil
+import numpy as np
+from datetime import datetime
+
+#Class import
+from IOService import ioService
+from FramePipeline import FrameRecordMerge
+
+formatVersion = 1
+channelNames = ['R', 'G', 'B'] #LED 0, 1, 2
+
+#Record of a frame saved : saved frame nb, camera frame index, channel (LED),
+#frame nb in its channel, FIRE time (s), odour valve and respiration signals
+indexDtype = np.dtype([('frame', '<i8'), ('cameraFrame', '<i8'), ('channel', '<i4'),
+                       ('channelFrame', '<i8'), ('time', '<f8'), ('valve', '<f4'),
+                       ('respiration', '<f4')])
+
+
+def containerPath(savePath, name):
+    return savePath+"/"+name+".ommi"
+
+
+class OmmiWriter(object):
+    """
+    Write the frames of an acquisition in an OMMI container, split by channel.
+    Same interface as saveFcts.ChannelDemuxWriter : the LED of a frame is
+    ledList[camera frame index] (given by setFrameIndex), the records come
+    from the RecordJoiner (saveFrameRecord), in the order of the frames.
+    The frames must come in order, from one thread. Completed chunks are
+    closed and synced by the I/O service. An existing container of the same
+    name is replaced.
+    """
+
+    def __init__(self, savePath, name, chunkFrames, ledList, service=None):
+        self.path = containerPath(savePath, name)
+        self.name = name
+        self.chunkFrames = chunkFrames
+        self.maxFrames = chunkFrames #Frames per file for the frame pipeline
+        self.ledList = ledList
+        self.service = service or ioService()
+        if os.path.exists(self.path):
+            #Container of an experiment overwritten : moved aside and deleted by the I/O
+            #service, the files of this session are never appended to old ones
+            oldPath = self.path+'.old%(number)d' % {"number": time.time_ns()}
+            os.replace(self.path, oldPath)
+            self.service.submit(shutil.rmtree, oldPath)
+        os.makedirs(self.path)
+        self.header = None          #Written at the first frame
+        self.chunks = {}            #LED : open chunk file
+        self.nbChannelFrames = [0]*len(channelNames)   #Frames written, per channel
+        self.nbChannelRecords = [0]*len(channelNames)  #Records written, per channel
+        self.frameIndexes = {}      #imageCount : camera frame index, of the frames not saved yet
+        self.indexFile = None       #Opened at the first record
+        self.nbUnknown = 0          #Frames out of the LED list (not saved)
+        self.recordMerge = FrameRecordMerge(self._recordWriting) #Records of the frames written only
+        self.closings = []
+
+    def _led(self, frameIndex):
+        if 0 <= frameIndex < len(self.ledList):
+            return self.ledList[frameIndex]
+        return None
+
+    def _headerWriting(self, img):
+        """
+        Write the header of the container (replaced in one step, never partial).
+        """
+        self.header = {"format":"OMMI container",
+                       "version":formatVersion,
+                       "name":self.name,
+                       "created":str(datetime.now()),
+                       "frameShape":list(img.shape),
+                       "dtype":img.dtype.str,
+                       "chunkFrames":self.chunkFrames,
+                       "channels":channelNames,
+                       "index":indexDtype.descr}
+        with open(self.path+'/header.json.part', 'w') as headerFile:
+            json.dump(self.header, headerFile, indent=4)
+            headerFile.flush()
+            os.fsync(headerFile.fileno())
+        os.replace(self.path+'/header.json.part', self.path+'/header.json')
+
+    def chunkPath(self, led, chunkNb):
+        return self.path+'/'+channelNames[led]+'_%(number)06d.raw' % {"number": chunkNb}
+
+    def setFrameIndex(self, imageCount, frameIndex):
+        """
+        Give the camera frame index of the frame imageCount, before it is saved.
+        """
+        self.frameIndexes[imageCount] = frameIndex
+
+    def save(self, img, imageCount):
+        """
+        Append the frame imageCount (starting at 0) to the chunk of its channel.
+        """
+        led = self._led(self.frameIndexes.pop(imageCount, imageCount)) #No frame index : no frame dropped
+        if led is None:
+            self.nbUnknown += 1
+            self.recordMerge.frameDone(imageCount, False)
+            return
+        if self.header is None:
+            self._headerWriting(img)
+        chunk = self.chunks.get(led)
+        if chunk is None:
+            chunk = open(self.chunkPath(led, self.nbChannelFrames[led]//self.chunkFrames), 'ab')
+            self.chunks[led] = chunk
+        chunk.write(np.ascontiguousarray(img, dtype=self.header["dtype"]).data)
+        self.nbChannelFrames[led] += 1
+        self.recordMerge.frameDone(imageCount)
+        if self.nbChannelFrames[led] % self.chunkFrames == 0: #Chunk complete
+            self._release(led)
+
+    def skip(self, imageCount):
+        """
+        Frame imageCount not saved (error) : no record for it.
+        """
+        self.frameIndexes.pop(imageCount, None)
+        self.recordMerge.frameDone(imageCount, False)
+
+    def _release(self, led):
+        chunk = self.chunks.pop(led, None)
+        if chunk is not None:
+            self.closings = [closing for closing in self.closings if not closing.done()]
+            self.closings.append(self.service.close(chunk, chunk.name))
+
+    def saveFrameRecord(self, frameIndex, imageCount, frameTime, odourValveSig, respirationSig):
+        """
+        Append the record of a frame to the index, once the frame is saved.
+        """
+        self.recordMerge.addRecord(imageCount, frameIndex, imageCount, frameTime, odourValveSig, respirationSig)
+
+    def _recordWriting(self, frameIndex, imageCount, frameTime, odourValveSig, respirationSig):
+        led = self._led(frameIndex)
+        if led is None:
+            return
+        if self.indexFile is None:
+            self.indexFile = open(self.path+'/index.bin', 'ab')
+        record = np.array([(imageCount, frameIndex, led, self.nbChannelRecords[led],
+                            frameTime, odourValveSig, respirationSig)], dtype=indexDtype)
+        self.indexFile.write(record.data)
+        self.nbChannelRecords[led] += 1
+        if sum(self.nbChannelRecords) % self.chunkFrames == 0:
+            self.indexFile.flush() #On the disk at the chunk rate, not at the end only
+
+    def closeTimestamps(self):
+        """
+        Close the index (once all the records are written).
+        """
+        if self.indexFile is not None:
+            self.service.close(self.indexFile, self.indexFile.name)
+            self.indexFile = None
+
+    def close(self):
+        """
+        Close the last chunks and wait until they are closed.
+        Return the nb of chunk files written.
+        """
+        for led in list(self.chunks.keys()):
+            self._release(led)
+        for closing in self.closings:
+            if closing.exception() is not None:
+                print('container chunk not closed properly : ', closing.exception())
+        self.closings = []
+        print('Frames per channel (R, G, B) : ', self.nbChannelFrames, ' out of the LED list : ', self.nbUnknown)
+        return sum([-(-nbFrames//self.chunkFrames) for nbFrames in self.nbChannelFrames]) #Rounded up
+
+
+class OmmiContainer(object):
+    """
+    Read an OMMI container. Frames are memory mapped : a frame is found in
+    O(1) from its saved frame nb (frame) or its position in its channel
+    (channelFrame), nothing is read before it is used.
+    Only the whole frames and records on the disk are used, so a container
+    cut by a crash can be read as it is.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path+'/header.json') as headerFile:
+            self.header = json.load(headerFile)
+        self.frameShape = tuple(self.header["frameShape"])
+        self.dtype = np.dtype(self.header["dtype"])
+        self.chunkFrames = self.header["chunkFrames"]
+        self.channels = self.header["channels"]
+        self.recordDtype = np.dtype([tuple(field) for field in self.header["index"]])
+        self.frameBytes = int(np.prod(self.frameShape))*self.dtype.itemsize
+        self.refresh()
+
+    def chunkPath(self, channel, chunkNb):
+        return self.path+'/'+self.channels[channel]+'_%(number)06d.raw' % {"number": chunkNb}
+
+    def refresh(self):
+        """
+        Read the nb of frames and records on the disk (container still written).
+        """
+        self.nbChannelFrames = []
+        for channel in range(len(self.channels)):
+            nbFrames = 0
+            chunkNb = 0
+            while os.path.isfile(self.chunkPath(channel, chunkNb)):
+                chunkFrames = os.path.getsize(self.chunkPath(channel, chunkNb))//self.frameBytes
+                nbFrames += chunkFrames
+                chunkNb += 1
+                if chunkFrames < self.chunkFrames: #Last chunk
+                    break
+            self.nbChannelFrames.append(nbFrames)
+        indexPath = self.path+'/index.bin'
+        nbRecords = os.path.getsize(indexPath)//self.recordDtype.itemsize if os.path.isfile(indexPath) else 0
+        if nbRecords:
+            records = np.memmap(indexPath, dtype=self.recordDtype, mode='r', shape=(nbRecords,))
+            #Records in the frames order : keep them up to the first frame not on the disk
+            onDisk = records['channelFrame'] < np.array(self.nbChannelFrames)[records['channel']]
+            nbRecords = int(np.argmin(onDisk)) if not onDisk.all() else nbRecords
+        self.nbRecords = nbRecords
+
+    def __len__(self):
+        return self.nbRecords
+
+    def records(self):
+        """
+        Return the index (structured array, see indexDtype), memory mapped.
+        """
+        if not self.nbRecords:
+            return np.zeros(0, dtype=self.recordDtype)
+        return np.memmap(self.path+'/index.bin', dtype=self.recordDtype, mode='r', shape=(self.nbRecords,))
+
+    def chunk(self, channel, chunkNb):
+        """
+        Return the frames of a chunk, memory mapped.
+        """
+        nbFrames = min(self.chunkFrames, self.nbChannelFrames[channel]-chunkNb*self.chunkFrames)
+        return np.memmap(self.chunkPath(channel, chunkNb), dtype=self.dtype, mode='r',
+                         shape=(nbFrames,)+self.frameShape)
+
+    def channelFrame(self, channel, channelFrame):
+        """
+        Return the frame nb channelFrame of a channel.
+        """
+        if not 0 <= channelFrame < self.nbChannelFrames[channel]:
+            raise IndexError('frame '+str(channelFrame)+' not in channel '+self.channels[channel])
+        return self.chunk(channel, channelFrame//self.chunkFrames)[channelFrame % self.chunkFrames]
+
+    def frame(self, frameNb):
+        """
+        Return the saved frame frameNb with its record.
+        """
+        record = self.records()[frameNb]
+        return (self.channelFrame(int(record['channel']), int(record['channelFrame'])), record)
+
+    def channelStack(self, channel, start=0, stop=None):
+        """
+        Return the frames start to stop of a channel in one array (copied).
+        """
+        stop = self.nbChannelFrames[channel] if stop is None else min(stop, self.nbChannelFrames[channel])
+        stack = np.empty((max(0, stop-start),)+self.frameShape, dtype=self.dtype)
+        frameNb = start
+        while frameNb < stop:
+            chunkNb = frameNb//self.chunkFrames
+            first = frameNb-chunkNb*self.chunkFrames
+            last = min(self.chunkFrames, stop-chunkNb*self.chunkFrames)
+            stack[frameNb-start:frameNb-start+last-first] = self.chunk(channel, chunkNb)[first:last]
+            frameNb += last-first
+        return stack
+
+    def exportTiff(self, folderPath=None, channels=None):
+        """
+        Write each channel in a .tif stack with its .txt timestamps file
+        (name_R.tif, name_R.txt..., the files of ParsingFiles.splitColorChannel).
+        Return the list of the .tif files written.
+        """
+        import tifffile #Only needed to export
+        folderPath = folderPath or os.path.dirname(self.path)
+        records = self.records()
+        tifsList = []
+        for channel in (range(len(self.channels)) if channels is None else channels):
+            if not self.nbChannelFrames[channel]:
+                continue
+            basePath = folderPath+'/'+self.header["name"]+'_'+self.channels[channel]
+            with tifffile.TiffWriter(basePath+'.tif', bigtiff=True) as tif:
+                for chunkNb in range(-(-self.nbChannelFrames[channel]//self.chunkFrames)):
+                    for img in self.chunk(channel, chunkNb):
+                        tif.write(img, contiguous=True)
+            channelRecords = records[records['channel'] == channel]
+            with open(basePath+'.txt', 'w') as textFile:
+                for record in channelRecords:
+                    textFile.write(str(record['time'])+'\t'+str(int(record['valve']))+'\n')
+            tifsList.append(basePath+'.tif')
+        return tifsList
+
+    def repair(self):
+        """
+        Truncate the files after a crash : whole frames and the records of the
+        frames on the disk only. Return the nb of records kept.
+        """
+        for channel in range(len(self.channels)):
+            nbFrames = self.nbChannelFrames[channel]
+            if nbFrames % self.chunkFrames or nbFrames == 0:
+                chunkPath = self.chunkPath(channel, nbFrames//self.chunkFrames)
+                if os.path.isfile(chunkPath):
+                    with open(chunkPath, 'rb+') as chunk:
+                        chunk.truncate((nbFrames % self.chunkFrames)*self.frameBytes)
+        if os.path.isfile(self.path+'/index.bin'):
+            with open(self.path+'/index.bin', 'rb+') as indexFile:
+                indexFile.truncate(self.nbRecords*self.recordDtype.itemsize)
+        self.refresh()
+        return self.nbRecords
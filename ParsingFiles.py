@@ -145,40 +145,78 @@ def splitColorChannel(filesName, txtArray, tifsList, processedFolderPath):
     blueTif.close()
 
 
-def txtFileSizeCorrection():
+def moveChannelFiles(filesName, filesFolder, processedFolderPath):
     """
-    Because the metadata and the are saved in 2 different threads,
-    when an acquisition is aborted we can not ensure that the nb of
-    frames are the same per file
+    Move the channel files written during the acquisition (see
+    saveFcts.ChannelDemuxWriter) in the processed folder : nothing to split.
+    Return True if there were channel files.
     """
-    ##TO IMPLEMENT
-    #could be useful in case of crash
-    print ('Text and tif file size correction')
+    moved = False
+    for color in ['R', 'G', 'B']:
+        for extension in ['.tif', '.txt']:
+            channelFile = filesName+'_'+color+extension
+            if os.path.isfile(filesFolder+'/'+channelFile):
+                os.replace(filesFolder+'/'+channelFile, processedFolderPath+'/'+channelFile) #Same disk : no copy
+                moved = True
+    return moved
+
+
+def txtFileSizeCorrection(txtArray, recordsPath):
+    """
+    Because the metadata and the frames are saved in 2 different threads,
+    we can not ensure that there is one metadata row per frame saved (frames
+    dropped by the camera, aborted acquisition).
+    Keep only the metadata rows of the frames saved in the .tif files, in the
+    order of the frames, using the records written by the RecordJoiner.
+    """
+    records = np.loadtxt(recordsPath, delimiter='\t', ndmin=2)
+    if records.shape[0] == 0:
+        return txtArray
+    #Records with a frame (column 1 : saved frame nb, -1 if dropped)
+    records = records[records[:,1] >= 0]
+    records = records[np.argsort(records[:,1])]
+    frameIndex = records[:,0].astype(int)
+    frameIndex = frameIndex[frameIndex < txtArray.shape[0]] #Metadata can stop before the last frame
+    print('Text and tif file size correction : ', txtArray.shape[0], ' metadata rows for ', frameIndex.shape[0], ' frames')
+    return txtArray[frameIndex]
+
+
+def tifStack(tifPath):
+    """
+    Return the frames of a .tif file as a (frames, height, width) array.
+    A contiguous stack (see saveFcts.ContiguousStack) is memory mapped : no
+    copy, only the frames used are read from the disk. Other files are read.
+    """
+    with tifffile.TiffFile(tifPath) as tif:
+        if len(tif.series) == 1 and tif.series[0].dataoffset is not None: #One series, contiguous and uncompressed
+            return tifffile.memmap(tifPath, mode='r')
+        return tif.asarray(key=range(len(tif.pages))) #All the pages (one series per page if written frame by frame)
 
 
 def splitTifs(tiffWriter, tifsList, numChannel, channel):
     """
-    Loop through the .tif files and save by channel
+    Loop through the .tif files and save by channel.
+    The frames are appended contiguously : the channel files can be memory
+    mapped too (see tifStack).
     """
     startNb = 0
     nbFrames = 0
     for tif in tifsList:
-        with  tifffile.TiffFile(tif) as tif:
-            images = tif.asarray() #WARNING EVEN NUMBER OF FRAMES
-
-            try :
-                startNb += nbFrames
-                nbFrames = int(images.shape[0])
-                segmentChannel = channel[startNb:startNb+nbFrames]##problem last frame
-                toSaveArray = np.nonzero(segmentChannel==numChannel)[0] #We now that it is 1D array
-                                                                        #np.nonzero is the same function as np.where
-            except:
-                print('no access to channel ?')
-            try:
-                for frameNb in toSaveArray:
-                    tiffWriter.save(images[frameNb])
-            except:
-                print('error with list')
+        images = tifStack(tif)
+
+        try :
+            startNb += nbFrames
+            nbFrames = int(images.shape[0])
+            segmentChannel = channel[startNb:startNb+nbFrames]##problem last frame
+            toSaveArray = np.nonzero(segmentChannel==numChannel)[0] #We now that it is 1D array
+                                                                    #np.nonzero is the same function as np.where
+        except:
+            print('no access to channel ?')
+        try:
+            for frameNb in toSaveArray:
+                tiffWriter.write(images[frameNb], contiguous=True)
+        except:
+            print('error with list')
 
 
 def splitTimestamps(textFile, time, odourValve, numChannel, channel):
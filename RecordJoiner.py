@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 17:21:03 2026
+
+@author: Johnstonlab
+
+Class of the join stage between the metadata thread and the frame thread.
+"""
+#Packages import
+import threading
+
+#Function import
+from saveFcts import saveRecord
+from IOService import ioService
+
+
+class RecordJoiner(object):
+    """
+    Join the metadata of each FIRE edge (metadata thread) with the frame
+    received from the camera (frame thread) and write one record per frame.
+    Both sides are matched by camera frame index, the timestamps are checked
+    against the offset measured on the first matched frame.
+    Each side is buffered in a small reorder window, so neither thread waits
+    for the other : when a frame index falls out of the window with only one
+    side, it is written as an unmatched record.
+    If channelWriter (see saveFcts.ChannelDemuxWriter, OmmiContainer.OmmiWriter),
+    the record of each frame saved is given to it too, in the order of the
+    frames.
+    """
+
+    #Status of a record
+    matched = 0
+    noFrame = 1     #FIRE edge without frame (frame dropped)
+    noMetadata = 2  #Frame without FIRE edge (edge missed)
+    timeMismatch = 3
+
+    def __init__(self, recordsFile, reorderWindow=64, timeTolerance=None, channelWriter=None):
+        self.recordsFile = recordsFile
+        self.channelWriter = channelWriter
+        self.reorderWindow = reorderWindow
+        self.timeTolerance = timeTolerance #(s) None to skip the timestamps check
+        self.timeOffset = None #camera time - FIRE time (s), measured on the first match
+
+        self.metadata = {} #frameIndex : (frameTime, led, odourValveSig, respirationSig, ledOnDuration)
+        self.frames = {}   #frameIndex : (imageCount, camera timestamp in ms)
+        self.nextIndex = 0 #Next frame index to write
+        self.lastIndex = -1 #Highest frame index received
+        self.counts = [0, 0, 0, 0] #Nb of records per status
+        self._lock = threading.Lock()
+
+    def addMetadata(self, frameIndex, frameTime, led, odourValveSig, respirationSig, ledOnDuration):
+        """
+        Metadata side : called for each FIRE edge.
+        """
+        with self._lock:
+            if frameIndex < self.nextIndex: #Too late, its frame was already written
+                self._write(frameIndex, None, (frameTime, led, odourValveSig, respirationSig, ledOnDuration))
+                return
+            self.metadata[frameIndex] = (frameTime, led, odourValveSig, respirationSig, ledOnDuration)
+            self._flush(frameIndex)
+
+    def addFrame(self, frameIndex, imageCount, timestamp):
+        """
+        Frame side : called for each frame popped from the circular buffer.
+        """
+        with self._lock:
+            if frameIndex < self.nextIndex:
+                self._write(frameIndex, (imageCount, timestamp), None)
+                return
+            self.frames[frameIndex] = (imageCount, timestamp)
+            self._flush(frameIndex)
+
+    def _flush(self, frameIndex):
+        """
+        Write the records which are complete or out of the reorder window.
+        """
+        self.lastIndex = max(self.lastIndex, frameIndex)
+        while self.nextIndex <= self.lastIndex:
+            index = self.nextIndex
+            complete = (index in self.metadata) and (index in self.frames)
+            if not complete and (self.lastIndex-index) < self.reorderWindow:
+                break
+            self._write(index, self.frames.pop(index, None), self.metadata.pop(index, None))
+            self.nextIndex += 1
+
+    def _write(self, frameIndex, frame, metadata):
+        """
+        Write the record of one frame index.
+        """
+        if frame is None and metadata is None:
+            return
+        if frame is None:
+            status = RecordJoiner.noFrame
+            frame = (-1, float('nan'))
+        elif metadata is None:
+            status = RecordJoiner.noMetadata
+            metadata = (float('nan'), -1, -1, float('nan'), float('nan'))
+        else:
+            status = self._timeCheck(frame[1], metadata[0])
+        self.counts[status] += 1
+        saveRecord(self.recordsFile, frameIndex, frame[0], frame[1], *metadata, status=status)
+        if self.channelWriter is not None and frame[0] >= 0:
+            self.channelWriter.saveFrameRecord(frameIndex, frame[0], metadata[0], metadata[2], metadata[3])
+
+    def _timeCheck(self, cameraTime, frameTime):
+        """
+        Compare the camera timestamp (ms) with the FIRE edge time (s).
+        """
+        if self.timeTolerance is None or cameraTime != cameraTime: #NaN : no camera timestamp
+            return RecordJoiner.matched
+        offset = cameraTime*0.001-frameTime
+        if self.timeOffset is None:
+            self.timeOffset = offset
+        if abs(offset-self.timeOffset) > self.timeTolerance:
+            return RecordJoiner.timeMismatch
+        return RecordJoiner.matched
+
+    def close(self):
+        """
+        Write all the records left in the window and close the records file.
+        Return the nb of records per status.
+        """
+        with self._lock:
+            self.reorderWindow = 0
+            self._flush(self.lastIndex)
+            ioService().close(self.recordsFile, self.recordsFile.name) #Closed and synced by the I/O thread
+            if self.channelWriter is not None:
+                self.channelWriter.closeTimestamps()
+        print('Records matched / no frame / no metadata / time mismatch : ', self.counts)
+        return self.counts
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 14:06:22 2026
+
+@author: Johnstonlab
+
+Class of the continuous recorder of the respiration and odour valve signals.
+"""
+#Packages import
+import json
+import threading
+import numpy as np
+
+#Class import
+from EdgeDetector import EdgeDetector
+from Labjack import ttlLevel, ttlLowLevel
+
+
+class RespirationRecorder(object):
+    """
+    Record the respiration and the odour valve signals at the LabJack stream
+    rate (kHz) instead of one value per frame.
+    The recorder is a listener of a LabjackStream : each block of samples is
+    written in a preallocated .npy file opened with a memory map. The files
+    are split in segments of segmentSeconds so the memory used stays bounded
+    over long loop sessions : only the current and the previous segments are
+    mapped.
+    The frame column gives the nearest FIRE edge of each sample : samples are
+    assigned to a frame up to the midpoint with the next edge, so this column
+    is filled when the next edge is detected.
+    The .json header lists the segments and the nb of valid samples of each.
+    """
+
+    dtype = np.dtype([('respiration', '<f4'), ('valve', '<f4'), ('frame', '<i4')])
+
+    def __init__(self, stream, savePath, name, respirationChannel=0, valveChannel=2,
+                 fireChannel=3, segmentSeconds=600.):
+        self.stream = stream
+        self.basePath = savePath+"/"+name+"_respiration"
+        self.respirationRow = stream.row(respirationChannel)
+        self.valveRow = stream.row(valveChannel)
+        self.fireRow = stream.row(fireChannel)
+        self.segmentSize = int(stream.scanFrequency*segmentSeconds)
+        self.fireDetector = EdgeDetector(stream.scanFrequency, ttlLevel, ttlLowLevel)
+
+        self.header = {'scanFrequency': stream.scanFrequency,
+                       'channels': {'respiration': respirationChannel,
+                                    'valve': valveChannel,
+                                    'fire': fireChannel},
+                       'startTime': None, #time() of the stream start
+                       'segmentSize': self.segmentSize,
+                       'segments': []}
+        self.segments = {} #Segment nb : memmap, only the last 2 are kept
+        self.firstSample = None #First stream sample recorded
+        self.sampleCount = 0 #Nb of samples recorded
+        self.edgeCount = 0 #Nb of FIRE edges detected = next frame index
+        self.lastEdge = None #Recorded sample of the last FIRE edge
+        self.pendingSample = 0 #First recorded sample without its final frame index
+        self._lock = threading.Lock()
+        self.recording = False
+
+    def start(self):
+        """
+        Subscribe to the stream, must be called before the stream starts.
+        """
+        self.recording = True
+        self.stream.addListener(self._newBlock)
+
+    def _segment(self, segmentNb):
+        """
+        Return the memmap of a segment, create the file if needed.
+        """
+        if segmentNb not in self.segments:
+            fileName = self.basePath+'_%(number)03d.npy' % {"number": segmentNb}
+            segment = np.lib.format.open_memmap(fileName, mode='w+', dtype=RespirationRecorder.dtype,
+                                                shape=(self.segmentSize,))
+            segment['frame'] = -1
+            self.segments[segmentNb] = segment
+            self.header['segments'].append({'file': fileName.split('/')[-1],
+                                            'firstSample': segmentNb*self.segmentSize,
+                                            'nbSamples': 0})
+            #Unmap the old segments, the frame index can't be backfilled further than the previous segment
+            for oldNb in [nb for nb in self.segments if nb < segmentNb-1]:
+                self._release(oldNb)
+        return self.segments[segmentNb]
+
+    def _release(self, segmentNb):
+        """
+        Flush a segment on the disk and unmap it.
+        """
+        segment = self.segments.pop(segmentNb)
+        segment.flush()
+        del segment
+
+    def _write(self, field, start, values):
+        """
+        Write values in a column from the recorded sample start, across segments.
+        Samples of the released segments are skipped.
+        """
+        stop = start+len(values)
+        while start < stop:
+            segmentNb = start//self.segmentSize
+            offset = start-segmentNb*self.segmentSize
+            nb = min(stop-start, self.segmentSize-offset)
+            if segmentNb >= min(self.segments.keys() or [segmentNb]):
+                segment = self._segment(segmentNb)
+                segment[field][offset:offset+nb] = values[:nb]
+                self.header['segments'][segmentNb]['nbSamples'] = max(self.header['segments'][segmentNb]['nbSamples'], offset+nb)
+            values = values[nb:]
+            start += nb
+
+    def _setFrame(self, start, stop, frameIndex):
+        """
+        Set the frame index of the recorded samples [start, stop[.
+        """
+        if stop > start:
+            self._write('frame', start, np.full(stop-start, frameIndex, dtype=np.int32))
+
+    def _newBlock(self, firstSample, block):
+        """
+        Stream listener : write a new block of samples and backfill the frame
+        index of the samples before the midpoint of each new pair of edges.
+        """
+        with self._lock:
+            if not self.recording:
+                return
+            if self.firstSample is None:
+                self.firstSample = firstSample
+                self.header['startTime'] = self.stream.startTime
+                self.header['firstStreamSample'] = firstSample
+            start = firstSample-self.firstSample
+            if start < self.sampleCount: #Overlap with the previous block
+                block = block[:, self.sampleCount-start:]
+                start = self.sampleCount
+            self._write('respiration', start, block[self.respirationRow])
+            self._write('valve', start, block[self.valveRow])
+            self.sampleCount = start+block.shape[1]
+
+            (edgeSamples, edgeTimes) = self.fireDetector.process(start, block[self.fireRow])
+            for edge in edgeSamples:
+                if self.lastEdge is None:
+                    self.pendingSample = edge #Samples before the first edge are set with the second edge
+                else:
+                    midpoint = (self.lastEdge+edge+1)//2
+                    if self.edgeCount == 1: #First frame also gets the samples before its edge
+                        self._setFrame(max(0, 2*self.lastEdge-midpoint), self.lastEdge, 0)
+                    self._setFrame(self.pendingSample, midpoint, self.edgeCount-1)
+                    self.pendingSample = midpoint
+                self.lastEdge = edge
+                self.edgeCount += 1
+
+    def close(self):
+        """
+        Stop recording, set the frame index after the last edge (half of the
+        last interval), flush the segments and write the .json header.
+        Return the nb of samples recorded.
+        """
+        with self._lock:
+            self.recording = False
+            if self.lastEdge is not None:
+                halfInterval = (self.lastEdge-self.pendingSample)+1
+                self._setFrame(self.pendingSample, min(self.sampleCount, self.lastEdge+halfInterval), self.edgeCount-1)
+            for segmentNb in list(self.segments.keys()):
+                self._release(segmentNb)
+            self.header['nbSamples'] = self.sampleCount
+            self.header['nbFrames'] = self.edgeCount
+            with open(self.basePath+'.json', 'w') as headerFile:
+                json.dump(self.header, headerFile, indent=4)
+        print('Respiration recorder : ', self.sampleCount, ' samples, ', self.edgeCount, ' FIRE edges')
+        return self.sampleCount
+
+
+def respirationLoading(headerPath):
+    """
+    Load a recording saved by RespirationRecorder from its .json header.
+    Return (header, records) with the valid samples of all the segments.
+    """
+    with open(headerPath, 'r') as headerFile:
+        header = json.load(headerFile)
+    folder = headerPath[:-len(headerPath.split('/')[-1])]
+    records = [np.load(folder+segment['file'], mmap_mode='r')[:segment['nbSamples']]
+               for segment in header['segments']]
+    if not records:
+        return (header, np.empty(0, dtype=RespirationRecorder.dtype))
+    return (header, np.concatenate(records))
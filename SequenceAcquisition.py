@@ -8,18 +8,31 @@ Class of Sequence Acquisition
 """
 #Packages import
 from PyQt5.QtCore import QThread, pyqtSignal
-from time import time, sleep
+from time import time, sleep, perf_counter
 from multiprocessing.pool import ThreadPool
+import threading
+import numpy as np
+import pymmcore
 
 
 #Class Import
-from ArduinoTeensy import Arduino
+from ArduinoTeensy import synchronization
 from SignalInterrupt import SignalInterrupt
+from SignalWatch import signalWatch
+from FramePipeline import FramePipeline, DropDetector
+from RecordJoiner import RecordJoiner
+from LabjackStream import LabjackStream
+from EdgeDetector import EdgeDetector
+from RespirationRecorder import RespirationRecorder
+from FrameCounter import FrameCounter
 
 #Function import
 import ArduinoTeensy
-from Labjack import greenOn, greenOff, redOn, redOff, blueOn, blueOff, waitForSignal, readSignal, readOdourValve, trigImage, risingEdge
-from saveFcts import filesInit, emptyTiffDel, tiffWritersClose, saveFrame, saveMetadata, cfgFileSaving
+from waitFcts import Backoff, PulseTimer
+from Labjack import waitForSignal, trigImage, risingEdge
+from Labjack import ledOn, ledOff, ledPulse, readSnapshot, odourValveStates, red_lj, green_lj, blue_lj, ttlLevel, ttlLowLevel
+from IOService import ioService
+from saveFcts import filesInit, saveMetadata, cfgFileSaving, recordsFileInit, pulseStatsSaving
 import saveFcts
 
 
@@ -33,6 +46,8 @@ class SequenceAcquisition(QThread):
     """
     nbFramesSig = pyqtSignal(int)
     progressSig = pyqtSignal(int)
+    frameQueueSig = pyqtSignal(int) #Fill of the frame pipeline queue (%)
+    droppedFramesSig = pyqtSignal(int) #Running count of frames dropped by the camera
     isFinished = pyqtSignal()
     isStarted = pyqtSignal()
     arduinoSyncStarted = pyqtSignal()
@@ -49,6 +64,7 @@ class SequenceAcquisition(QThread):
         self.labjack = labjack
 
         self.acqRunning = True
+        self.stopEvent = threading.Event() #Set when the acquisition is aborted or the loop paused, wakes the waiting threads
 
         #Initialize with information from the GUI
         self.experimentName = None
@@ -64,7 +80,7 @@ class SequenceAcquisition(QThread):
         #Initialized in other method of this class
         self.nbFrames = None
         self.ledList = None     #Initialized in _sequenceInit method
-        self.tiffWriterList = None  #Initialized in filesInit method from SaveFcts.py
+        self.tiffWriter = None      #RollingTiffWriter (ContiguousTiffWriter, ChannelDemuxWriter) initialized in filesInit method from SaveFcts.py
         self.textFile = None        #Initialized in filesInit method from SaveFcts.py
         self.acquMode = None
         self.seqMode = None
@@ -73,6 +89,36 @@ class SequenceAcquisition(QThread):
         self.stimName = None
         self.loopRunning = True #by default we need to have this value set to True for the frameSaving thread
 
+        #Frame saving pipeline settings
+        self.nbFrameWriters = 1     #Nb of writer workers (each .tif file is written by one worker)
+        self.frameQueueSize = 64    #Max nb of frames (or blocks of frames) waiting to be saved
+        self.batchDrain = True      #Pop all the pending images of the circular buffer in one pass
+        self.drainBatchSize = None  #Max nb of images in one block, None : all the pending images
+        self.framePipeline = None   #Initialized in _frameSaving method
+        self.dropDetector = None    #Initialized in _frameSaving method
+        self.recordJoiner = None    #Initialized in sequencePreparation or _loopPreparation method
+        self.reorderWindow = 64     #Nb of frames buffered to join metadata and frames
+        self.storageMode = 'tiff'   #'tiff' one page per frame, 'contiguous' memory mappable stacks or 'container' OMMI container (see saveFcts.filesInit)
+        self.channelDemux = False   #Split the frames in _R, _G, _B stacks while saving them (see saveFcts.ChannelDemuxWriter)
+        self.keepInterleaved = True #Channel demux : save the interleaved .tif files too
+
+        #Auxiliary signals capture settings
+        self.streamMode = False     #Take the metadata from the LabJack stream instead of polling each AIN
+        self.streamFrequency = 2500 #Scans per second of the LabJack stream
+        self.labjackStream = None   #Initialized in _seqAcqCyclops method
+        self.respirationRecording = False #Record respiration and odour valve at the stream rate (.npy files)
+        self.respirationSegment = 600. #Length (s) of each respiration file
+        self.respirationRecorder = None #Initialized in _seqAcqCyclops method
+        self.counterMode = False    #Count the FIRE pulses with a U3 counter (FIRE wired on the counter pin), not with the stream
+        self.counterPinOffset = 8   #Counter0 on EIO0
+        self.frameCounter = None    #Initialized in _seqAcqCyclops method
+
+        #LED pulses timing (Labjack mode)
+        self.pulseSpinThreshold = 0.002 #Last part (s) of a LED pulse timed by spinning instead of sleeping
+        self.pulseTimer = None      #Initialized in _ledSwitching method
+        self.syncTimeout = 10.      #Max time (s) to configure all the LED drivers
+        self.hardwarePulse = False  #LED pulses timed by the LabJack clock (one transaction per frame)
+
 
     def __del__(self):
         self.wait()
@@ -131,33 +177,39 @@ class SequenceAcquisition(QThread):
         """
         imageCount=0
         print('Transmitted ledOnDuration value : ',ledOnDuration)
+        ledLines = [red_lj, green_lj, blue_lj] #LabJack line of each LED of ledList
+        self.pulseTimer = PulseTimer(self.pulseSpinThreshold)
 
         #Timestamp to flag the beginning of acquisition
         startAcquisitionTime = time()
         while(imageCount<(self.nbFrames) and self.acqRunning):
             #Will return only if ARM output signal from the camera raise
             #to check if the camera is ready to receive trigger signal
-            if waitForSignal(self.labjack, "TTL", "AIN", 0): 	#WaitForSignal return TRUE when AIN0 input is HIGH (>3V),
+            if waitForSignal(self.labjack, "TTL", "AIN", 0, stopEvent=self.stopEvent): 	#WaitForSignal return TRUE when AIN0 input is HIGH (>3V),
 
+                ledLine = ledLines[self.ledList[imageCount]]
                 onTime = time()		#flag the begining of a LED illumination
-                if self.ledList[imageCount] == 0: 	#RED
-                    redOn(self.labjack)
-                    sleep(ledOnDuration)
-                    redOff(self.labjack)
-                elif self.ledList[imageCount] == 1:	#GREEN
-                    greenOn(self.labjack)
-                    sleep(ledOnDuration)
-                    greenOff(self.labjack)
-                else:								#BLUE
-                    blueOn(self.labjack)
-                    sleep(ledOnDuration)
-                    blueOff(self.labjack)
-                offTime = time()	#flag the end of a LED illumination
-
-                effectiveLedOnDuration = offTime-onTime
+                if self.hardwarePulse:
+                    #Whole pulse and metadata signals read in one transaction, width timed by the U3
+                    (snapshot, effectiveLedOnDuration) = ledPulse(self.labjack, ledLine, ledOnDuration, (2, 3))
+                    offTime = onTime+effectiveLedOnDuration
+                else:
+                    onStart = perf_counter()
+                    ledOn(self.labjack, ledLine) #LED line + trig in one transaction
+                    onLatency = perf_counter()-onStart
+                    #The timer runs from the return of ledOn to the send of ledOff, its
+                    #statistics are the software timing error only. Each LED switch happens
+                    #when its packet reaches the U3 : the LED is on about onLatency + the
+                    #timed interval (same USB latency both ways)
+                    self.pulseTimer.start()
+                    effectiveLedOnDuration = onLatency+self.pulseTimer.wait(max(0., ledOnDuration-onLatency))
+                    offTime = time()	#flag the end of a LED illumination
+                    #LED line + trig off and metadata signals read in one transaction
+                    snapshot = ledOff(self.labjack, ledLine, (2, 3))
+
                 frameTime = offTime - startAcquisitionTime #Taking the off time to be synchronized with metadata
-                odourValveSig = readOdourValve(self.labjack, 2)
-                respirationSig = readSignal(self.labjack, 3)
+                odourValveSig = snapshot.valve[0] #AIN2
+                respirationSig = snapshot.ain[1] #AIN3
                 saveMetadata(	self.textFile,
 								str(frameTime),
 								str(self.ledList[imageCount]),
@@ -165,28 +217,54 @@ class SequenceAcquisition(QThread):
 								str(odourValveSig),
 								str(respirationSig),
 								str(effectiveLedOnDuration))
+                self.recordJoiner.addMetadata(imageCount, frameTime, self.ledList[imageCount],
+                                              odourValveSig, respirationSig, effectiveLedOnDuration)
                 imageCount+=1
 
 
-        #close the metadata .txt file
-        self.textFile.close()
+        #close the metadata .txt file (closed and synced by the I/O thread)
+        ioService().close(self.textFile, self.textFile.name)
+        pulseStats = self.pulseTimer.stats()
+        pulseStats["Hardware timed pulses"] = self.hardwarePulse
+        pulseStats["Timed interval"] = "U3 clock" if self.hardwarePulse else "ledOn return to ledOff send"
+        print('LED pulses timing : ', pulseStats)
+        pulseStatsSaving(self.savePath, self.experimentName, pulseStats)
         print('end of the ledSwitchingThread')
         return imageCount
 
+    def _channelSplit(self):
+        """
+        Return True if the frames are split by channel while saved (channel
+        demux or OMMI container).
+        """
+        return self.channelDemux or self.storageMode == 'container'
+
     def _frameSaving(self):
         """
-        In charge of saving frames
+        Capture stage of the frame saving pipeline.
+        Only drains the circular buffer of the camera, the frames are saved by
+        the writer workers of the FramePipeline.
         """
         self.mmc.clearCircularBuffer()
         imageCount=0
+        self.dropDetector = DropDetector()
+        self.framePipeline = FramePipeline(self.tiffWriter,
+                                           1 if self._channelSplit() else self.nbFrameWriters, #Channel stacks written in order
+                                           self.frameQueueSize,
+                                           self.progressSig.emit)
+        self.framePipeline.start()
+        queueFill = 0
+        #Wait between 2 checks of the circular buffer, short compared to a frame
+        backoff = Backoff(min(0.002, self.cycleTime/10.), stopEvent=self.stopEvent)
         self.mmc.startContinuousSequenceAcquisition(1)
         while(imageCount<(self.nbFrames) and self.acqRunning and self.loopRunning):
             if self.mmc.getRemainingImageCount() > 0: #Returns number of image in circular buffer, stop when seq acq finished #Enter this loop BETWEEN acquisition
                 #trigImage(labjack) #Generate a pulse, which allows to flag the entry in this code statement with the oscilloscope
-                img = self.mmc.popNextImage() #Gets and removes the next image from the circular buffer
-                saveFrame(img, self.tiffWriterList, (imageCount), self.maxFrames) # saving frame of previous acquisition
-                imageCount +=1
-                self.progressSig.emit(imageCount)
+                imageCount = self._circularBufferDraining(imageCount, self.nbFrames-imageCount) #Saved by the writer workers
+                queueFill = self._frameQueueReport(queueFill)
+                backoff.reset()
+            else:
+                backoff.wait()
 
 
 
@@ -194,49 +272,99 @@ class SequenceAcquisition(QThread):
         self.mmc.stopSequenceAcquisition()
 
         #### IF ABORTED acquisition #####
-        self._circularBufferCleaning(imageCount)
+        imageCount = self._circularBufferCleaning(imageCount)
+
+        #Wait for the writers to save all the frames
+        print('Saved frames : ', self.framePipeline.stop())
+        print('Dropped frames : ', self.dropDetector.droppedFrames)
 
-        #Close tiff file open
-        tiffWritersClose(self.tiffWriterList)
+        #Close tiff file open (no empty file created if aborted)
+        print(self.tiffWriter.close(), ' .tif file(s) written')
         print('end of the _frameSavingThread')
         return imageCount
 
+    def _frameQueueReport(self, lastQueueFill):
+        """
+        Emit the fill of the frame pipeline queue when it changes.
+        """
+        queueFill = int(self.framePipeline.fillLevel()*100)
+        if queueFill != lastQueueFill:
+            self.frameQueueSig.emit(queueFill)
+        return queueFill
+
+    def _circularBufferDraining(self, imageCount, maxImages=None):
+        """
+        Hand the images pending in the circular buffer to the frame pipeline.
+        In batch drain mode, all the pending images (up to maxImages) are
+        popped in one pass into a preallocated (N, H, W) block, else only the
+        next image is popped.
+        Return the total nb of frames handed to the frame pipeline.
+        """
+        if not self.batchDrain:
+            img = self._popNextImage(imageCount)
+            self.framePipeline.put(img, imageCount)
+            return imageCount+1
+
+        nbImages = self.mmc.getRemainingImageCount()
+        if self.drainBatchSize:
+            nbImages = min(nbImages, self.drainBatchSize)
+        if maxImages is not None:
+            nbImages = min(nbImages, maxImages)
+        if nbImages < 1:
+            return imageCount
+        img = self._popNextImage(imageCount)
+        block = np.empty((nbImages,)+img.shape, dtype=img.dtype)
+        block[0] = img
+        for i in range(1, nbImages):
+            block[i] = self._popNextImage(imageCount+i)
+        self.framePipeline.putBatch(block, imageCount)
+        return imageCount+nbImages
+
+    def _popNextImage(self, imageCount):
+        """
+        Get and remove the next image from the circular buffer with its
+        metadata. The camera image number is checked to detect dropped frames
+        and the frame is handed to the record join stage.
+        """
+        md = pymmcore.Metadata()
+        img = self.mmc.popNextImageMD(md)
+        (imageNumber, timestamp) = self.dropDetector.readMetadata(md)
+        if imageNumber is None:
+            #No image number from the camera, suppose that no frame was dropped
+            (frameIndex, dropped) = (imageCount+self.dropDetector.droppedFrames, 0)
+        else:
+            (frameIndex, dropped) = self.dropDetector.check(imageNumber)
+            if dropped:
+                self.droppedFramesSig.emit(self.dropDetector.droppedFrames)
+        if timestamp is None:
+            timestamp = float('nan')
+        if self._channelSplit():
+            self.tiffWriter.setFrameIndex(imageCount, frameIndex) #LED of the frame
+        self.recordJoiner.addFrame(frameIndex, imageCount, timestamp)
+        return img
+
     def _circularBufferCleaning(self, imageCount):
         """
         Get the last images in the circular buffer if the acquisition was aborted.
         This step ensure that there is the same amount of metadata than frames saved.
+        Return the total nb of frames handed to the frame pipeline.
         """
         if (not self.acqRunning) or (not self.loopRunning): #Check if sequence acquisition was aborted or loop was paused.
             print(('cycleTime :',self.cycleTime))
             sleep(self.cycleTime)
             print(('remaining images in the circular buffer :',self.mmc.getRemainingImageCount()))
             while(self.mmc.getRemainingImageCount() > 0):
-                print('getting last image, num : ', imageCount)
-                img = self.mmc.popNextImage() #Gets and removes the next image from the circular buffer
-                saveFrame(img, self.tiffWriterList, (imageCount), self.maxFrames) # saving frame of previous acquisition
-                imageCount +=1
-                sleep(self.cycleTime)
-            #Close tiff file open
-            tiffWritersClose(self.tiffWriterList)
-            if ((self.nbFrames/self.maxFrames)>=1): #check that multiples .tif were initialized
-                # --> CHECK WICH .tif are empty and suppress it
-                if self.stimName:
-                    emptyTiffDel(self.stimName,
-                                  self.savePath,
-                                  imageCount,
-                                  self.maxFrames,
-                                  self.tiffWriterList)
-                else:
-                    emptyTiffDel(self.experimentName,
-                                  self.savePath,
-                                  imageCount,
-                                  self.maxFrames,
-                                  self.tiffWriterList)
+                print('getting last images from num : ', imageCount)
+                imageCount = self._circularBufferDraining(imageCount)
+                if not self.mmc.getRemainingImageCount():
+                    sleep(self.cycleTime) #Let a last frame reach the buffer
+        return imageCount
 
     def _sequenceAcqu(self):
         """
         Prepare and start the sequence acquisition. Write frame in an tiff file during acquisition.
         This function use the labjack to detect a camera trigger.
+        Run when acquMode is "Labjack" (not offered by the GUI, which starts "Run" or "Loop").
         --> Inputs and outputs :
             - Camera.ARM > Labjack.AIN0
             - Camera.TRIGGER > Labjack.FIO7
@@ -267,6 +395,8 @@ class SequenceAcquisition(QThread):
         #close the pool and wait for the work to finish
         pool.close()
         pool.join()
+        #Write the last records of the join stage
+        self.recordJoiner.close()
         print('sequ acq done')
         return imageCount
 
@@ -282,11 +412,12 @@ class SequenceAcquisition(QThread):
             self.startAcquisitionTime = time()
         print('timestamp got')
         while(imageCount<(self.nbFrames) and self.acqRunning and self.loopRunning):
-            if risingEdge(self.labjack, 3): #Labjack, channel, timeout(s)
+            if risingEdge(self.labjack, 3, stopEvent=self.stopEvent): #Labjack, channel, timeout(s)
                 startTime = time()
                 frameTime = startTime - self.startAcquisitionTime #Taking the off time to be synchronized with metadata
-                odourValveSig = readOdourValve(self.labjack, 2)
-                respirationSig = readSignal(self.labjack, 0)
+                snapshot = readSnapshot(self.labjack, (2, 0)) #Valve and respiration from the same instant
+                odourValveSig = snapshot.valve[0] #AIN2
+                respirationSig = snapshot.ain[1] #AIN0
                 saveMetadata(	self.textFile,
 								str(frameTime),
 								str(self.ledList[imageCount]),
@@ -294,13 +425,108 @@ class SequenceAcquisition(QThread):
 								str(odourValveSig),
 								str(respirationSig),
 								str(0)) #Maybe not the best practice
+                self.recordJoiner.addMetadata(imageCount, frameTime, self.ledList[imageCount],
+                                              odourValveSig, respirationSig, 0)
                 imageCount+=1
 
-        #close the metadata .txt file
-        self.textFile.close()
+        #close the metadata .txt file (closed and synced by the I/O thread)
+        ioService().close(self.textFile, self.textFile.name)
         print('end of the ledSwitchingThread')
         return imageCount
 
+    def _metadataSavingCounter(self):
+        """
+        Save the metadata of each frame counted by the FIRE hardware counter.
+        The counter and the metadata signals are read in one transaction at
+        each poll, the rows are tied to the counter values : no frame is lost
+        if the thread is late, the frames counted between 2 polls share the
+        signals read and their time is estimated from the cycle time.
+        """
+        counter = self.frameCounter
+        imageCount=0
+
+        #Timestamp to flag the beginning of acquisition
+        if not self.startAcquisitionTime:
+            self.startAcquisitionTime = time()
+        backoff = Backoff(min(0.002, self.cycleTime/10.), stopEvent=self.stopEvent)
+        while(imageCount<(self.nbFrames) and self.acqRunning and self.loopRunning):
+            snapshot = counter.read((2, 0)) #Valve and respiration with the counter
+            if snapshot.count <= imageCount:
+                backoff.wait()
+                continue
+            backoff.reset()
+            lastCount = min(snapshot.count, self.nbFrames)
+            if lastCount-imageCount > 1:
+                print(lastCount-imageCount, ' FIRE pulses counted since the last poll')
+            odourValveSig = snapshot.valve[0] #AIN2
+            respirationSig = snapshot.ain[1] #AIN0
+            for frameIndex in range(imageCount, lastCount):
+                frameTime = snapshot.time-(snapshot.count-1-frameIndex)*self.cycleTime-self.startAcquisitionTime
+                saveMetadata(	self.textFile,
+								str(frameTime),
+								str(self.ledList[frameIndex]),
+								str(frameIndex),
+								str(odourValveSig),
+								str(respirationSig),
+								str(0))
+                self.recordJoiner.addMetadata(frameIndex, frameTime, self.ledList[frameIndex],
+                                              odourValveSig, respirationSig, 0)
+            imageCount = lastCount
+
+        #close the metadata .txt file (closed and synced by the I/O thread)
+        ioService().close(self.textFile, self.textFile.name)
+        print('end of the metadataSavingCounter thread')
+        return imageCount
+
+    def _metadataSavingStream(self):
+        """
+        Save the metadata of each frame from the LabJack stream buffer.
+        The FIRE rising edges are detected in each new block of AIN3 samples,
+        the valve (AIN2) and respiration (AIN0) signals are taken at the sample
+        of the edge.
+        """
+        stream = self.labjackStream
+        fireRow = stream.row(3)
+        valveRow = stream.row(2)
+        respRow = stream.row(0)
+        fireDetector = EdgeDetector(stream.scanFrequency, ttlLevel, ttlLowLevel)
+        imageCount=0
+
+        #Timestamp to flag the beginning of acquisition
+        if not self.startAcquisitionTime:
+            self.startAcquisitionTime = time()
+        streamOffset = stream.startTime - self.startAcquisitionTime #Stream time to acquisition time
+        nextSample = 0
+        while(imageCount<(self.nbFrames) and self.acqRunning and self.loopRunning):
+            if not stream.waitForSamples(nextSample, 0.1):
+                if not stream.running:
+                    print('LabJack stream stopped before the end of the acquisition')
+                    break
+                continue
+            (firstSample, block) = stream.window(nextSample)
+            nextSample = firstSample+block.shape[1]
+            (edgeSamples, edgeTimes) = fireDetector.process(firstSample, block[fireRow])
+            edgeSamples = edgeSamples[:self.nbFrames-imageCount]-firstSample #Index in the block
+            frameTimes = edgeTimes[:self.nbFrames-imageCount]+streamOffset
+            odourValveSigs = odourValveStates(block[valveRow, edgeSamples])
+            respirationSigs = block[respRow, edgeSamples]
+            for (frameTime, odourValveSig, respirationSig) in zip(frameTimes, odourValveSigs, respirationSigs):
+                saveMetadata(	self.textFile,
+								str(frameTime),
+								str(self.ledList[imageCount]),
+								str(imageCount),
+								str(odourValveSig),
+								str(respirationSig),
+								str(0))
+                self.recordJoiner.addMetadata(imageCount, frameTime, self.ledList[imageCount],
+                                              odourValveSig, respirationSig, 0)
+                imageCount+=1
+
+        #close the metadata .txt file (closed and synced by the I/O thread)
+        ioService().close(self.textFile, self.textFile.name)
+        print('end of the metadataSavingStream thread')
+        return imageCount
+
 
     def _seqAcqCyclops(self):
         """
@@ -317,10 +543,32 @@ class SequenceAcquisition(QThread):
         """
         print('Cyclops running')
 
+        metadataSaving = self._metadataSaving
+        if self.streamMode or self.respirationRecording:
+            #Auxiliary signals sampled by the LabJack stream
+            self.labjackStream = LabjackStream(self.labjack, scanFrequency=self.streamFrequency)
+            if self.respirationRecording:
+                self.respirationRecorder = RespirationRecorder(self.labjackStream,
+                                                               self.savePath,
+                                                               self.stimName if self.acquMode == "Loop" else self.experimentName,
+                                                               segmentSeconds=self.respirationSegment)
+                self.respirationRecorder.start()
+            self.labjackStream.start()
+        if self.labjackStream is not None:
+            #AIN can't be polled while streaming : FIRE edges taken from the stream
+            metadataSaving = self._metadataSavingStream
+            if self.counterMode:
+                print('WARNING : counter mode ignored, the FIRE edges are taken from the LabJack stream')
+        elif self.counterMode:
+            #Frames counted by the LabJack counter
+            self.frameCounter = FrameCounter(self.labjack, self.counterPinOffset)
+            self.frameCounter.start()
+            metadataSaving = self._metadataSavingCounter
+
         pool = ThreadPool(processes=2)
         print('Pool initialized')
 
-        ledSwitchingThread = pool.apply_async(self._metadataSaving,())
+        ledSwitchingThread = pool.apply_async(metadataSaving,())
         sleep(0.001) ## WAIT FOR INITIALIZATION AND WAITFORSIGNAL FCT
         frameSavingThread = pool.apply_async(self._frameSaving,())
         imageCount = ledSwitchingThread.get()
@@ -329,6 +577,19 @@ class SequenceAcquisition(QThread):
         #close the pool and wait for the work to finish
         pool.close()
         pool.join()
+        if self.frameCounter is not None:
+            #Cross-check of the FIRE pulses with the camera frame numbers
+            self.frameCounter.crossCheck(self.dropDetector)
+            self.frameCounter.stop()
+            self.frameCounter = None
+        if self.labjackStream is not None:
+            self.labjackStream.stop()
+            self.labjackStream = None
+        if self.respirationRecorder is not None:
+            self.respirationRecorder.close()
+            self.respirationRecorder = None
+        #Write the last records of the join stage
+        self.recordJoiner.close()
         print('sequ acq done')
         return imageCount
 
@@ -347,19 +608,16 @@ class SequenceAcquisition(QThread):
                    round(exp*self.expRatio[1],3),
                    round(exp*self.expRatio[2],3)]
 
+        #All the drivers are configured in parallel
         if self.seqMode == "rgbMode":
-            ledDriverNb=[0,1,2] #[Red, Green, Blue]
-            for driverNb in ledDriverNb:
-                driver = Arduino(driverNb)
-                driver.synchronization(illumTime,
-                                       rgbLedRatio = self.rgbLedRatio)
+            synchronization(illumTime,
+                            rgbLedRatio = self.rgbLedRatio,
+                            timeout = self.syncTimeout)
         elif self.seqMode == 'rbMode':
-            ledDriverNb=[0,1,2] #[Red, Green, Blue]
-            for driverNb in ledDriverNb:
-                driver = Arduino(driverNb)
-                driver.synchronization(illumTime,
-                                       greenFrameInterval = self.greenFrameInterval,
-                                       colorMode = self.colorMode)
+            synchronization(illumTime,
+                            greenFrameInterval = self.greenFrameInterval,
+                            colorMode = self.colorMode,
+                            timeout = self.syncTimeout)
 
         self.arduinoSyncFinished.emit()
 
@@ -395,10 +653,16 @@ class SequenceAcquisition(QThread):
                                       'Zyla') #WARNING > modulabilty (there is a way to get device label but it's not so easy)
 
         #initialization of the acquisition saving files : .tif (frames) and .txt (metadata)
-        (self.tiffWriterList, self.textFile) = filesInit(   self.savePath,
-                                                            self.experimentName,
-                                                            self.nbFrames,
-                                                            self.maxFrames)
+        (self.tiffWriter, self.textFile) = filesInit(   self.savePath,
+                                                        self.experimentName,
+                                                        self.maxFrames,
+                                                        self.storageMode,
+                                                        self.ledList if self._channelSplit() else None,
+                                                        self.keepInterleaved)
+        self.recordJoiner = RecordJoiner(recordsFileInit(self.savePath, self.experimentName),
+                                         self.reorderWindow,
+                                         self.cycleTime/2.,
+                                         self.tiffWriter if self._channelSplit() else None)
         #send all informations to each LED driver
         self.arduinoSync()
 
@@ -440,24 +704,31 @@ class SequenceAcquisition(QThread):
         self.nbFrames=10000 #TO DO --> better place for this line of code
 
         self.stimName= self.experimentName+'_S%(number)03d' % {"number": stimNumber} #%02d return a 2 char string : 1-->01
-        (self.tiffWriterList, self.textFile) = filesInit(   self.savePath,
-                                                            self.stimName,
-                                                            self.nbFrames,
-                                                            self.maxFrames)
         if self.seqMode == "rgbMode":
             self._rgbSequenceInit()
         elif self.seqMode == 'rbMode':
             self._rbSequenceInit()
+        (self.tiffWriter, self.textFile) = filesInit(   self.savePath,
+                                                        self.stimName,
+                                                        self.maxFrames,
+                                                        self.storageMode,
+                                                        self.ledList if self._channelSplit() else None,
+                                                        self.keepInterleaved)
+        self.recordJoiner = RecordJoiner(recordsFileInit(self.savePath, self.stimName),
+                                         self.reorderWindow,
+                                         self.cycleTime/2.,
+                                         self.tiffWriter if self._channelSplit() else None)
         self.arduinoSync()
 
     def run(self):
         self.isStarted.emit()
         #Launching the frame acquisition
-#        if self.acquMode == "Labjack":
-#            print'sequ acq about to start'
-#            self.imageCount = self._sequenceAcqu()
-#            print'run fct done'
-        if self.acquMode == "Run":
+        if self.acquMode == "Labjack":
+            #LEDs switched by the LabJack lines (set acquMode to "Labjack", the GUI starts "Run" or "Loop")
+            print('sequ acq about to start')
+            self.imageCount = self._sequenceAcqu()
+            print('run fct done')
+        elif self.acquMode == "Run":
             #self.arduinoSync()
             self.imageCount = self._seqAcqCyclops()
         elif self.acquMode == "Loop":
@@ -469,6 +740,7 @@ class SequenceAcquisition(QThread):
             self.stopInterrupt = SignalInterrupt(self.labjack, interruptAIN, waitToCheckSignal, stopSignalState)
             self.stopInterrupt.stateReachedInterrupt.connect(self.pauseLoop)
             self.stopInterrupt.start()
+            syncWatch = signalWatch(self.labjack) #Same service as the stopInterrupt
 
             stimNumber = 1
             self.startAcquisitionTime = time()
@@ -478,8 +750,11 @@ class SequenceAcquisition(QThread):
                 self._loopPreparation(stimNumber)
                 #Wait for the raise of the SYNC signal
                 #if waitForSignal(self.labjack, channel=1): #waitForSignal(device, signalType="TTL", channelType="AIN", channel=1)
-                while(not risingEdge(self.labjack, interruptAIN)) and self.acqRunning:
-                    continue
+                self.stopEvent.clear() #Only an abort can stop the waiting
+                #Rising edge following the last falling edge (end of the previous stim), even if it came during the preparation
+                syncLowTime = syncWatch.lastEdges.get((interruptAIN, False), self.startAcquisitionTime)
+                while self.acqRunning and not syncWatch.waitEdge(interruptAIN, True, syncLowTime, stopEvent=self.stopEvent):
+                    pass
                 if self.acqRunning:
                     self.loopRunning = True
                     self.imageCount = self._seqAcqCyclops()
@@ -487,9 +762,11 @@ class SequenceAcquisition(QThread):
                     stimNumber += 1
                 else:
                     #Close tiff file open
-                    tiffWritersClose(self.tiffWriterList)
+                    self.tiffWriter.close()
                     #close the metadata .txt file
                     self.textFile.close()
+                    self.recordJoiner.close()
+                    ioService().drain() #No file of the stim still open
                     saveFcts.acqFilesDel(self.stimName,self.savePath)
                     print('abort loop')
             self.stopInterrupt.abort() #Stop the listenning action of the Interrupt
@@ -507,6 +784,7 @@ class SequenceAcquisition(QThread):
         """
         print('SYNC stim detected LOW')
         self.loopRunning = False
+        self.stopEvent.set()
 
     def abort(self):
         """
@@ -514,5 +792,6 @@ class SequenceAcquisition(QThread):
         """
         try:
             self.acqRunning = False
+            self.stopEvent.set()
         except:
             print('Cannot abort properly')
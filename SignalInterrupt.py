@@ -4,46 +4,32 @@ Created on Thu Oct 03 16:06:44 2019
 
 @author: Johnstonlab
 
-File containing the waiting for a signal thread.
+File containing the waiting for a signal object.
 """
-from PyQt5.QtCore import QThread, pyqtSignal
-import threading
+from PyQt5.QtCore import QObject, pyqtSignal
 
 ####functions import
-from Labjack import readSignal
+from SignalWatch import signalWatch
 
-class SignalInterrupt(QThread):
+class SignalInterrupt(QObject):
     """
     An instance of this class will listen to a designated signal and emit pyqtSignal to interrupt a running thread or task
+    The signal is read by the SignalWatch service of the LabJack, shared by
+    all the instances listening to this device.
     """
     interrupt = pyqtSignal(bool)
     stateReachedInterrupt =pyqtSignal()
 
     def __init__(self, labjack, channel, waitTimeSeconds=0.5, waitedState = None, parent=None):
-        QThread.__init__(self,parent)
+        QObject.__init__(self,parent)
         self.labjack = labjack
         self.channel = channel
-        self.waitTimeSeconds = waitTimeSeconds
+        self.waitTimeSeconds = waitTimeSeconds #Not used anymore, the channel is sampled at the SignalWatch rate
         self.waitedState = waitedState
-        self.running = True
-        print('S interrupt created with scan time : ', self.waitTimeSeconds)
-
-    def __del__(self):
-        self.wait()
-
-    def _signalState(self, signalValue):
-        """
-        Take the value of the signal given in argument and return a boolean
-        to describe the state of the signal.
-        HIGH (>2.4) > True
-        LOW (<0.8) > False
-        """
-        state = None
-        if signalValue > 2.4:
-            state = True
-        if signalValue < 0.8:
-            state = False
-        return state
+        self.running = False
+        self.watch = signalWatch(labjack)
+        self._token = None
+        print('S interrupt created on channel ', self.channel, ' sampled at ', self.watch.rate, ' Hz')
 
     def _checkWantedState(self, signalState):
         """
@@ -55,28 +41,32 @@ class SignalInterrupt(QThread):
         else:
             print('Interrupt rejected (non expected state)')
 
-    def run(self):
+    def _edgeReceived(self, channel, signalState, edgeTime):
         """
-        Default function of any QThread object
-        Called by classInstance.start() to launch the thread
+        Called by the SignalWatch thread for each edge of the channel.
         """
-        print ('Run fct of Signal Interrupt instance called')
-
-        signalPrevState = self._signalState(readSignal(self.labjack, self.channel))
+        if not self.running:
+            return
+        self.interrupt.emit(signalState)
+        print('interrupt detected')
+        if self.waitedState != None:
+            self._checkWantedState(signalState)
 
-        ticker = threading.Event()
-        while (not ticker.wait(self.waitTimeSeconds)) and (self.running):
-            signalState = self._signalState(readSignal(self.labjack, self.channel))
-            if signalPrevState != signalState:
-                    self.interrupt.emit(signalState)
-                    print('interrupt detected')
-                    if self.waitedState != None:
-                        self._checkWantedState(signalState)
-            signalPrevState =self._signalState(readSignal(self.labjack, self.channel))
-        print('run fct of Interrupt done')
+    def start(self):
+        """
+        Start listening to the signal.
+        """
+        print ('Signal Interrupt instance started')
+        if self._token is None:
+            self.running = True
+            self._token = self.watch.subscribe(self.channel, self._edgeReceived)
 
     def abort(self):
         """
-        Stop the main thread if no interrupt detected.
+        Stop listening to the signal if no interrupt detected.
         """
         self.running = False
+        if self._token is not None:
+            self.watch.unsubscribe(self._token)
+            self._token = None
+        print('Signal Interrupt instance stopped')
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 15:27:09 2026
+
+@author: Johnstonlab
+
+File containing the signal watch service : one thread per LabJack reading all
+the watched signals.
+"""
+from PyQt5.QtCore import QThread, pyqtSignal
+import threading
+from time import time
+
+####functions import
+from Labjack import readSnapshot, ttlLevel, ttlLowLevel
+
+#SignalWatch of each device (id(device) : watch)
+watches = {}
+
+
+def signalWatch(device, rate=None):
+    """
+    Return the SignalWatch of a device, created at the first call.
+    rate (Hz) changes the sampling rate if given.
+    """
+    watch = watches.get(id(device))
+    if watch is None:
+        watch = SignalWatch(device)
+        watches[id(device)] = watch
+    if rate is not None:
+        watch.rate = rate
+    return watch
+
+
+class SignalWatch(QThread):
+    """
+    Service sampling all the subscribed AIN channels of a LabJack in one
+    transaction per tick (see Labjack.readSnapshot) at a configurable rate.
+    The state of each channel is HIGH (>2.4V) or LOW (<0.8V), it keeps its
+    previous state in between. Each change of state is an edge, sent with its
+    timestamp to the subscribers of the channel and with the edge pyqtSignal.
+    The thread runs only while there are subscribers.
+    """
+    edge = pyqtSignal(int, bool, float) #channel, state, time()
+
+    def __init__(self, labjack, rate=200., parent=None):
+        QThread.__init__(self,parent)
+        self.labjack = labjack
+        self.rate = rate #Snapshots per second
+        self.subscribers = {} #token : (channel, callback)
+        self.states = {} #channel : last state (None if unknown)
+        self.lastEdges = {} #(channel, state) : time of the last edge
+        self.running = False
+        self._nextToken = 0
+        self._lock = threading.Lock()
+        self._stopEvent = threading.Event()
+
+    def __del__(self):
+        self.wait()
+
+    def subscribe(self, channel, callback):
+        """
+        Call callback(channel, state, edgeTime) for each edge of the channel.
+        Return a token for unsubscribe.
+        """
+        with self._lock:
+            token = self._nextToken
+            self._nextToken += 1
+            self.subscribers[token] = (channel, callback)
+            self.states.setdefault(channel, None)
+            self._stopEvent.clear()
+            if not self.running:
+                self.wait() #Last run ending
+                self.running = True
+                self.start()
+        return token
+
+    def unsubscribe(self, token):
+        """
+        Stop sending edges to a subscriber, the thread stops with the last one.
+        """
+        with self._lock:
+            (channel, callback) = self.subscribers.pop(token, (None, None))
+            if channel not in [subscribedChannel for (subscribedChannel, callback) in self.subscribers.values()]:
+                self.states.pop(channel, None) #Not sampled anymore
+            if not self.subscribers:
+                self._stopEvent.set()
+
+    def waitEdge(self, channel, state, after=None, timeout=None, stopEvent=None):
+        """
+        Wait for an edge of the channel to the given state, happening after
+        the time after (time()) if given, else after the call.
+        Return True if the edge came, False if timed out or stopEvent set.
+        """
+        edgeEvent = threading.Event()
+        def edgeReceived(edgeChannel, edgeState, edgeTime):
+            if edgeState == state:
+                edgeEvent.set()
+        token = self.subscribe(channel, edgeReceived)
+        try:
+            if after is not None and self.lastEdges.get((channel, state), 0.) > after:
+                return True
+            deadline = None if timeout is None else time()+timeout
+            while not edgeEvent.wait(0.01):
+                if stopEvent is not None and stopEvent.is_set():
+                    return False
+                if deadline is not None and time() > deadline:
+                    return False
+            return True
+        finally:
+            self.unsubscribe(token)
+
+    def _signalState(self, signalValue, prevState):
+        """
+        HIGH (>ttlLevel) > True
+        LOW (<ttlLowLevel) > False
+        """
+        if signalValue > ttlLevel:
+            return True
+        if signalValue < ttlLowLevel:
+            return False
+        return prevState
+
+    def run(self):
+        """
+        Sample the subscribed channels until there is no subscriber.
+        """
+        print('Signal watch started at ', self.rate, ' Hz')
+        while True:
+            with self._lock:
+                if not self.subscribers:
+                    self.running = False
+                    break
+                channels = sorted(self.states.keys())
+                subscribers = list(self.subscribers.values())
+            try:
+                snapshot = readSnapshot(self.labjack, channels)
+            except Exception as e:
+                print('Signal watch read error : ', e)
+                self._stopEvent.wait(1./self.rate)
+                continue
+            for (channel, signalValue) in zip(channels, snapshot.ain):
+                prevState = self.states.get(channel)
+                state = self._signalState(signalValue, prevState)
+                with self._lock:
+                    if channel in self.states: #Still subscribed
+                        self.states[channel] = state
+                if prevState is None or state == prevState:
+                    continue
+                self.lastEdges[(channel, state)] = snapshot.time
+                self.edge.emit(channel, state, snapshot.time)
+                for (subscribedChannel, callback) in subscribers:
+                    if subscribedChannel == channel:
+                        callback(channel, state, snapshot.time)
+            self._stopEvent.wait(1./self.rate)
+        print('Signal watch stopped')
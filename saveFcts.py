@@ -16,9 +16,15 @@ from datetime import date
 import json
 import os
 import fnmatch
+import shutil
 from datetime import datetime
 import threading
 
+#Class import
+from IOService import ioService
+from FramePipeline import FrameRecordMerge
+from OmmiContainer import OmmiWriter
+
 
 
 #print "Tiffile trial"
@@ -35,27 +41,6 @@ def saveImage(mmc):
       img = mmc.getImage()
       imsave('test.tif', img)
 
-def saveFrame(img, tiffWriterList, imageCount, maxFrames):
-    ## SOURCE : https://stackoverflow.com/questions/20529187/what-is-the-best-way-to-save-image-metadata-alongside-a-tif-with-python
-    ## TAGS list : https://github.com/blink1073/tifffile/blob/master/tifffile/tifffile.py#L5000
-    ## Tags plugins : https://imagej.nih.gov/ij/plugins/tiff-tags.html
-    ## METADATA types : https://github.com/blink1073/tifffile/blob/master/tifffile/tifffile.py#L7749
-    ## Metadata plugin : https://imagej.nih.gov/ij/plugins/metadata/MetaData.pdf
-    #metadata = dict(microscope='george', shape=img.shape, dtype=img.dtype.str)
-    #metadata = json.dumps(metadata)
-    #extra_tags = [(270, 's', 0, str(datetime.now()), False)] #[(code, dtype, count, value, writeonce)] #306 = DateTime
-
-
-    tiffWriterList[imageCount/maxFrames].save(img) #Remember : / is an integer division, return an integer
-    if((imageCount+1)%maxFrames == 0): #If the file is complete, nb frames = max frames (!imageCount start at 0!)
-        print('There is a .tif file to close - time :', datetime.now())
-        tifToClose =tiffWriterList[((imageCount+1)/maxFrames)-1] # goal : to close the completed tif, ensure that frames are saved in case of crash
-        thread1 = threading.Thread(target=tiffClose, args=(tifToClose,))
-        #https://stackoverflow.com/questions/15085348/what-is-the-use-of-join-in-python-threading
-        thread1.setDaemon(True) #Daemonized thread 'ignores' lifetime of other threads - no more delay
-        thread1.start()
-    #Write LED and timestamp in metadata"
-
 def saveMetadata(textFile, time, led, imageCount, odourValveSig, respirationSig, ledOnDuration):
     """
     Save the metadata of each frame in a given .txt file.
@@ -65,6 +50,25 @@ def saveMetadata(textFile, time, led, imageCount, odourValveSig, respirationSig,
     textFile.write(time+'\t'+led+'\t'+imageCount+'\t'+odourValveSig+'\t'+respirationSig+'\t'+ledOnDuration+'\n')
 
 
+def recordsFileInit(savePath, name):
+    """
+    Initialize the .tsv file where the joined record of each frame is written.
+    """
+    return open(savePath+"/"+name+"_records.tsv", 'w')
+
+def saveRecord(recordsFile, frameIndex, imageCount, cameraTime, frameTime, led,
+               odourValveSig, respirationSig, ledOnDuration, status):
+    """
+    Save the joined record of a frame, separated by a tab space :
+    camera frame index, saved frame nb (-1 if dropped), camera timestamp (ms),
+    FIRE time (s), LED, odour valve, respiration, LED on duration and status
+    (see RecordJoiner class).
+    """
+    recordsFile.write('\t'.join([str(frameIndex), str(imageCount), str(cameraTime),
+                                 str(frameTime), str(led), str(odourValveSig),
+                                 str(respirationSig), str(ledOnDuration), str(status)])+'\n')
+
+
 def cfgFileSaving(name, nbFrames, duration, ledIllumRatio, ledTriggerMode,
                   ledSwitchingMode, rgbLedRatio, greenFrameInterval, framerate,
                   folderPath,colorMode, mmc, deviceLabel):
@@ -120,6 +124,14 @@ def cfgFileSaving(name, nbFrames, duration, ledIllumRatio, ledTriggerMode,
     print('saving succeed')
     return savePath
 
+def pulseStatsSaving(savePath, name, pulseStats):
+    """
+    Save the jitter statistics of the LED pulses (see waitFcts.PulseTimer) in
+    a JSON file next to the configuration file.
+    """
+    with open(savePath+"/"+name+"_pulseTiming.json", 'w') as outfile:
+        json.dump(pulseStats, outfile, indent=4)
+
 def jsonFileLoading(filePath):
     """
     Open a json file and create a python dictionnary.
@@ -132,42 +144,288 @@ def jsonFileLoading(filePath):
             print('error in loading the file')
     return pyDict
 
-def filesInit(savePath, name, nbFrames, maxFrames):
+class RollingTiffWriter(object):
     """
-    Initialize the right number of .tif files to save the frames.
-    Initialize a .txt file to save metadata related to each frame.
+    Write the frames of an acquisition in .tif files of maxFrames frames each
+    (name0001.tif, name0002.tif...).
+    A file is opened only when its first frame comes and closed by the I/O
+    service (see IOService) as soon as its last frame is written : the nb of
+    files open stays the same whatever the length of the session, no empty
+    file is created and the total nb of frames doesn't need to be known (loop
+    mode). If sync, each closed file is written on the disk (fsync).
+    Files can be written in parallel by several threads (see FramePipeline),
+    the frames of one file must come from one thread, in order.
     """
-    #Initiate a list of TiffWriter object (one per file)
-    tifList=[]
-    if ((nbFrames%maxFrames) > 0 ): ##checking if nbFrames/maxFrames returned an int
-        for i in range(0,int(nbFrames/maxFrames)+1):
-            filename = savePath+"/"+name+'%(number)04d.tif' % {"number": i+1} #%04d return a 4 char string : 1-->0001
-            tif = tifffile.TiffWriter(filename) #See tifffile.py for others param
-            tifList.append(tif)
-    else:
-        for i in range(0,(nbFrames/maxFrames)):
-            filename = savePath+"/"+name+'%(number)04d.tif' % {"number": i+1} #%04d return a 4 char string : 1-->0001
-            tif = tifffile.TiffWriter(filename) #See tifffile.py for others param
-            tifList.append(tif)
-    print(len(tifList),' Tif(s) initiated')
 
-    #Inititate a .txt file where the metadata will be written
-    textFile = open(savePath+"/"+name+".txt", 'w')
+    def __init__(self, savePath, name, maxFrames, sync=True, service=None):
+        self.basePath = savePath+"/"+name
+        self.maxFrames = maxFrames
+        self.sync = sync
+        self.service = service or ioService()
+        self.writers = {} #File index : TiffWriter of the files open
+        self.nbFiles = 0 #Nb of files created
+        self.closings = [] #Futures of the files closing
+        self._lock = threading.Lock()
+
+    def fileName(self, fileIndex):
+        return self.basePath+'%(number)04d.tif' % {"number": fileIndex+1} #%04d return a 4 char string : 1-->0001
+
+    def _open(self, fileIndex, img):
+        return tifffile.TiffWriter(self.fileName(fileIndex)) #See tifffile.py for others param
+
+    def _write(self, tif, img, imageCount):
+        tif.write(img)
+
+    def _writer(self, fileIndex, img):
+        """
+        Return the writer of a file, opened at the first call.
+        """
+        with self._lock:
+            tif = self.writers.get(fileIndex)
+        if tif is None:
+            tif = self._open(fileIndex, img)
+            with self._lock:
+                self.writers[fileIndex] = tif
+                self.nbFiles = max(self.nbFiles, fileIndex+1)
+        return tif
+
+    def save(self, img, imageCount):
+        """
+        Write the frame imageCount (starting at 0) in its file.
+        """
+        fileIndex = imageCount//self.maxFrames
+        self._write(self._writer(fileIndex, img), img, imageCount)
+        if (imageCount+1)%self.maxFrames == 0: #If the file is complete, nb frames = max frames (!imageCount start at 0!)
+            self._release(fileIndex)
 
-    return (tifList, textFile)
+    def skip(self, imageCount):
+        """
+        Frame imageCount not saved (error) : its file is still released if it
+        was its last frame.
+        """
+        if (imageCount+1)%self.maxFrames == 0:
+            self._release(imageCount//self.maxFrames)
 
+    def _release(self, fileIndex):
+        """
+        Hand a completed file to the I/O service, off the saving path.
+        Blocks if the I/O service is late (back-pressure).
+        """
+        with self._lock:
+            tif = self.writers.pop(fileIndex, None)
+            self.closings = [closing for closing in self.closings if not closing.done()]
+        if tif is None:
+            return
+        print('There is a .tif file to close - time :', datetime.now())
+        closing = self.service.close(tif, self.fileName(fileIndex) if self.sync else None)
+        with self._lock:
+            self.closings.append(closing)
+
+    def close(self):
+        """
+        Close the files still open and wait until all the files are closed.
+        Return the nb of files created.
+        """
+        with self._lock:
+            fileIndexes = list(self.writers.keys())
+        for fileIndex in fileIndexes:
+            self._release(fileIndex)
+        with self._lock:
+            closings = self.closings
+            self.closings = []
+        for closing in closings:
+            if closing.exception() is not None:
+                print('.tif file not closed properly : ', closing.exception())
+        return self.nbFiles
 
-def emptyTiffDel(name, savePath, imageCount, maxFrames, tiffWriterList):
+
+class ContiguousStack(object):
     """
-    Supress the empty tiff generated for an aborted sequence acquisition.
+    .tif stack of nbFrames frames, uncompressed and contiguous, preallocated
+    on the disk when created and written through a memory map : any frame can
+    be read back with tifffile.memmap (or np.memmap) without decoding.
     """
-    for i in range((imageCount/maxFrames)+1,len(tiffWriterList)):   #All files that are empty (imageCount/maxFrames)+1, will be suppressed
-        filename = savePath+"/"+name+'%(number)04d.tif' % {"number": i+1}
-        try:
-            os.remove(filename)
-            print('Empty .tif suppression succeed')
-        except OSError as e:  ## if failed, report it back to the user ##
-            print(("Error: %s - %s." % (e.filename, e.strerror)))
+
+    def __init__(self, path, nbFrames, frameShape, dtype):
+        self.path = path
+        self.stack = tifffile.memmap(path, shape=(nbFrames,)+tuple(frameShape), dtype=dtype,
+                                     bigtiff=True, photometric='minisblack')
+        self.nbWritten = 0 #Nb of frames of the stack holding data
+
+    def write(self, img, frameNb):
+        self.stack[frameNb] = img
+        self.nbWritten = max(self.nbWritten, frameNb+1)
+
+    def close(self):
+        """
+        Flush the frames on the file. A stack not complete (end of the
+        acquisition) is rewritten with its frames only, its shape stays true.
+        """
+        self.stack.flush()
+        if self.nbWritten < len(self.stack):
+            frames = self.stack[:self.nbWritten]
+            tifffile.imwrite(self.path+'.part', frames, bigtiff=True, photometric='minisblack') #Uncompressed numpy array : contiguous
+            del frames
+            self.stack = None #Unmap the file before replacing it
+            os.replace(self.path+'.part', self.path)
+        self.stack = None
+
+
+class ContiguousTiffWriter(RollingTiffWriter):
+    """
+    RollingTiffWriter writing ContiguousStack files : each file is created at
+    its first frame with the shape (maxFrames, height, width) of this frame.
+    """
+
+    def _open(self, fileIndex, img):
+        return ContiguousStack(self.fileName(fileIndex), self.maxFrames, img.shape, img.dtype)
+
+    def _write(self, tif, img, imageCount):
+        tif.write(img, imageCount%self.maxFrames)
+
+
+class ChannelDemuxWriter(object):
+    """
+    Route each frame, at write time, in the stack of the channel of its LED
+    (name_R.tif, name_G.tif, name_B.tif) and its timestamp and odour valve in
+    the channel .txt file (name_R.txt...) : the same files as
+    ParsingFiles.splitColorChannel, without the split pass after the
+    acquisition. The stacks are appended contiguously (memory mappable).
+    The LED of a frame is ledList[camera frame index] : the capture stage gives
+    the frame index of each saved frame (setFrameIndex), dropped frames don't
+    shift the channels. The timestamps come from the joined records (see
+    RecordJoiner), one line per frame saved : the lines are written once the
+    frame is (see FramePipeline.FrameRecordMerge), a frame not saved has none.
+    If interleavedWriter, the frames are saved in the interleaved files too.
+    The frames must come in order, from one thread.
+    """
+
+    channelNames = ['R', 'G', 'B'] #LED 0, 1, 2
+
+    def __init__(self, savePath, name, maxFrames, ledList, interleavedWriter=None, service=None):
+        self.basePath = savePath+"/"+name
+        self.maxFrames = maxFrames
+        self.ledList = ledList
+        self.interleavedWriter = interleavedWriter
+        self.service = service or ioService()
+        self.stacks = {}        #LED : TiffWriter of the channel stack, opened at its first frame
+        self.textFiles = {}     #LED : timestamps file of the channel, opened at its first line
+        self.frameIndexes = {}  #imageCount : camera frame index, of the frames not saved yet
+        self.nbChannelFrames = [0]*len(ChannelDemuxWriter.channelNames)
+        self.nbUnknown = 0      #Frames out of the LED list (saved in no channel)
+        self.recordMerge = FrameRecordMerge(self._timestampWriting)
+
+    def channelPath(self, led, extension):
+        return self.basePath+'_'+ChannelDemuxWriter.channelNames[led]+extension
+
+    def _led(self, frameIndex):
+        if 0 <= frameIndex < len(self.ledList):
+            return self.ledList[frameIndex]
+        return None
+
+    def setFrameIndex(self, imageCount, frameIndex):
+        """
+        Give the camera frame index of the frame imageCount, before it is saved.
+        """
+        self.frameIndexes[imageCount] = frameIndex
+
+    def save(self, img, imageCount):
+        """
+        Write the frame imageCount (starting at 0) in the stack of its channel.
+        """
+        led = self._led(self.frameIndexes.pop(imageCount, imageCount)) #No frame index : no frame dropped
+        if led is None:
+            self.nbUnknown += 1
+            self.recordMerge.frameDone(imageCount, False)
+        else:
+            stack = self.stacks.get(led)
+            if stack is None:
+                stack = tifffile.TiffWriter(self.channelPath(led, '.tif'), bigtiff=True)
+                self.stacks[led] = stack
+            stack.write(img, contiguous=True)
+            self.nbChannelFrames[led] += 1
+            self.recordMerge.frameDone(imageCount)
+        if self.interleavedWriter is not None:
+            self.interleavedWriter.save(img, imageCount)
+
+    def skip(self, imageCount):
+        """
+        Frame imageCount not saved (error) : no timestamp for it.
+        """
+        self.frameIndexes.pop(imageCount, None)
+        self.recordMerge.frameDone(imageCount, False)
+        if self.interleavedWriter is not None:
+            self.interleavedWriter.skip(imageCount)
+
+    def saveFrameRecord(self, frameIndex, imageCount, frameTime, odourValveSig, respirationSig):
+        """
+        Write the timestamp of a frame in the .txt file of its channel (same
+        format as ParsingFiles.splitTimestamps), once the frame is saved.
+        """
+        self.recordMerge.addRecord(imageCount, frameIndex, frameTime, odourValveSig)
+
+    def _timestampWriting(self, frameIndex, frameTime, odourValveSig):
+        led = self._led(frameIndex)
+        if led is None:
+            return
+        textFile = self.textFiles.get(led)
+        if textFile is None:
+            textFile = open(self.channelPath(led, '.txt'), 'w')
+            self.textFiles[led] = textFile
+        textFile.write(str(frameTime)+'\t'+str(int(odourValveSig))+'\n')
+
+    def closeTimestamps(self):
+        """
+        Close the channel .txt files (once all the records are written).
+        """
+        for led in list(self.textFiles.keys()):
+            textFile = self.textFiles.pop(led)
+            self.service.close(textFile, textFile.name)
+
+    def close(self):
+        """
+        Close the channel stacks and the interleaved files, wait until they
+        are closed. Return the nb of .tif files written.
+        """
+        closings = [self.service.close(stack, self.channelPath(led, '.tif'))
+                    for (led, stack) in self.stacks.items()]
+        nbFiles = len(self.stacks)
+        self.stacks = {}
+        if self.interleavedWriter is not None:
+            nbFiles += self.interleavedWriter.close()
+        for closing in closings:
+            if closing.exception() is not None:
+                print('channel .tif file not closed properly : ', closing.exception())
+        print('Frames per channel (R, G, B) : ', self.nbChannelFrames, ' out of the LED list : ', self.nbUnknown)
+        return nbFiles
+
+
+#Storage modes of the frames, see filesInit (and 'container')
+storageModes = {'tiff':RollingTiffWriter, 'contiguous':ContiguousTiffWriter}
+
+def filesInit(savePath, name, maxFrames, storageMode='tiff', ledList=None, interleaved=True):
+    """
+    Initialize the writer of the .tif files where the frames are saved (files
+    created during the acquisition, see RollingTiffWriter) :
+    'tiff' one page per frame, 'contiguous' preallocated stacks readable with
+    tifffile.memmap (see ContiguousStack), 'container' OMMI container split
+    by channel, chunks of maxFrames frames (see OmmiContainer, needs ledList).
+    If ledList is given, the frames are split by channel while written (see
+    ChannelDemuxWriter), the interleaved files are kept only if interleaved.
+    Initialize a .txt file to save metadata related to each frame.
+    """
+    if storageMode == 'container':
+        tiffWriter = OmmiWriter(savePath, name, maxFrames, ledList)
+    else:
+        tiffWriter = storageModes[storageMode](savePath, name, maxFrames)
+    if ledList is not None and storageMode != 'container':
+        tiffWriter = ChannelDemuxWriter(savePath, name, maxFrames, ledList,
+                                        tiffWriter if interleaved else None)
+
+    #Inititate a .txt file where the metadata will be written
+    textFile = open(savePath+"/"+name+".txt", 'w')
+
+    return (tiffWriter, textFile)
 
 
 def acqFilesDel(fileBaseName, filesPath):
@@ -178,16 +436,14 @@ def acqFilesDel(fileBaseName, filesPath):
     for file in os.listdir(filesPath):
         if fnmatch.fnmatch(file, fileBaseName+'*'):
             try:
-                os.remove(filesPath+'/'+file)
+                if os.path.isdir(filesPath+'/'+file): #OMMI container
+                    shutil.rmtree(filesPath+'/'+file)
+                else:
+                    os.remove(filesPath+'/'+file)
                 print((file+' suppression succeed'))
             except OSError as e:  ## if failed, report it back to the user ##
                 print(("Error: %s - %s." % (e.filename, e.strerror)))
 
-def tiffWritersClose(tifList):
-    for tif in tifList:
-        tif.close()
-        print('tif closed')
-
 def tiffClose(tif):
     tif.close()
     print('tif closed at time : ', datetime.now())
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 14:05:12 2026
+
+@author: Johnstonlab
+
+File containing the waiting functions shared by the acquisition threads.
+Instead of spinning, a polling loop waits with an adaptive backoff : the first
+waits only release the GIL, then the sleep time doubles up to a maximum small
+compared to the signal it waits for. Waits are done on a threading.Event
+when one is given, so an abort wakes the waiting thread immediately.
+Precise intervals (LED pulses) are timed with a coarse sleep followed by a
+short spin on perf_counter_ns.
+"""
+
+from time import perf_counter, perf_counter_ns, sleep
+import numpy as np
+
+
+class Backoff(object):
+    """
+    Adaptive backoff for polling loops.
+    Call wait() each time the polled event did not happen and reset() when it
+    happened. If a stopEvent (threading.Event) is given, the wait is
+    interrupted as soon as it is set.
+    """
+
+    def __init__(self, maxSleep=0.001, minSleep=0.00005, nbYields=10, stopEvent=None):
+        self.maxSleep = maxSleep
+        self.minSleep = min(minSleep, maxSleep)
+        self.nbYields = nbYields
+        self.stopEvent = stopEvent
+        self.reset()
+
+    def reset(self):
+        """
+        Restart from the shortest wait.
+        """
+        self.nbWaits = 0
+        self.sleepTime = self.minSleep
+
+    def wait(self):
+        """
+        Wait before the next poll.
+        Return True if the stopEvent is set.
+        """
+        if self.nbWaits < self.nbYields:
+            waitTime = 0 #Only release the GIL
+        else:
+            waitTime = self.sleepTime
+            self.sleepTime = min(2*self.sleepTime, self.maxSleep)
+        self.nbWaits += 1
+        if self.stopEvent is not None:
+            return self.stopEvent.wait(waitTime)
+        sleep(waitTime)
+        return False
+
+
+class Deadline(object):
+    """
+    Deadline of a timeout in seconds, measured with perf_counter.
+    A None timeout never expires.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        if timeout is None:
+            self.end = None
+        else:
+            self.end = perf_counter()+timeout
+
+    def remaining(self):
+        """
+        Return the time left before the deadline (None if no deadline).
+        """
+        if self.end is None:
+            return None
+        return max(0., self.end-perf_counter())
+
+    def expired(self):
+        """
+        Return True once the deadline is reached.
+        """
+        return (self.end is not None) and (perf_counter() >= self.end)
+
+
+def waitUntil(condition, timeout=None, maxSleep=0.001, stopEvent=None):
+    """
+    Poll condition() with an adaptive backoff until it returns True.
+    Return True if the condition was reached, False if the timeout expired or
+    the stopEvent was set.
+    """
+    deadline = Deadline(timeout)
+    backoff = Backoff(maxSleep, stopEvent=stopEvent)
+    while not condition():
+        if deadline.expired():
+            return False
+        if backoff.wait():
+            return False
+    return True
+
+
+class PulseTimer(object):
+    """
+    High resolution timer of the LED pulses.
+    The OS sleep can be late by more than a millisecond : the timer sleeps
+    until spinThreshold (s) before the end of the pulse, then spins on
+    perf_counter_ns for the last stretch.
+    The error (effective - requested duration) of each pulse is kept to
+    compute the jitter statistics, only the last historySize pulses are used
+    for the percentile.
+    """
+
+    def __init__(self, spinThreshold=0.002, historySize=10000):
+        self.spinThreshold = spinThreshold
+        self.historySize = historySize
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the statistics.
+        """
+        self.errors = np.zeros(self.historySize) #Ring buffer of the last errors (s)
+        self.nbPulses = 0
+        self.errorSum = 0.
+        self.maxError = 0.
+        self.startNs = None
+
+    def start(self):
+        """
+        Flag the beginning of a pulse.
+        """
+        self.startNs = perf_counter_ns()
+        return self.startNs
+
+    def wait(self, duration):
+        """
+        Wait until duration (s) after start() and return the effective
+        duration (s).
+        """
+        endNs = self.startNs+int(duration*1e9)
+        coarseSleep = (endNs-perf_counter_ns())*1e-9-self.spinThreshold
+        if coarseSleep > 0:
+            sleep(coarseSleep)
+        while perf_counter_ns() < endNs:
+            pass
+        effectiveDuration = (perf_counter_ns()-self.startNs)*1e-9
+        self._record(effectiveDuration-duration)
+        return effectiveDuration
+
+    def _record(self, error):
+        self.errors[self.nbPulses % self.historySize] = error
+        self.nbPulses += 1
+        self.errorSum += error
+        self.maxError = max(self.maxError, error)
+
+    def stats(self):
+        """
+        Return the jitter statistics (us) in a dictionary.
+        """
+        lastErrors = self.errors[:min(self.nbPulses, self.historySize)]*1e6
+        if self.nbPulses == 0:
+            return {"Nb of pulses": 0}
+        return {"Nb of pulses": self.nbPulses,
+                "Spin threshold (s)": self.spinThreshold,
+                "Mean error (us)": self.errorSum/self.nbPulses*1e6,
+                "P99 error (us)": float(np.percentile(lastErrors, 99)),
+                "Max error (us)": self.maxError*1e6}